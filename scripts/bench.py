@@ -0,0 +1,235 @@
+"""Timing benchmarks of WarsawGTFS, run from the repository root:
+    python -m scripts.bench [--against <checkout>] [--repeat N] parse <ZTM file>
+    python -m scripts.bench [--against <checkout>] [--repeat N] line
+    python -m scripts.bench [--against <checkout>] [--repeat N] shapes
+    python -m scripts.bench [--against <checkout>] [--repeat N] brigades <GTFS file> <API responses> <yyyymmdd>
+
+Every benchmark is run in a separate interpreter, in a temporary directory.
+With --against, it's also run on another checkout of WarsawGTFS (e.g. an older commit created with `git worktree add`),
+and outputs created by both are compared.
+"""
+import argparse
+import filecmp
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PARSE_CONFIG = {"nameDecap": False, "nameDecapOffline": False, "getMissingStops": False, "getRailwayPlatforms": False,
+                 "parseSKM": True, "parseKM": True, "parseWKD": False, "shapes": False, "addMetro": False}
+
+_PARSE_SCRIPT = """
+import time
+from scripts import parser
+best = None
+for i in range({repeat}):
+    start = time.perf_counter()
+    parser.parse({file!r}, {config!r})
+    took = time.perf_counter() - start
+    best = took if best is None else min(best, took)
+print(best)
+"""
+
+_LINE_TRIPS = [250, 500, 1000, 2000]
+_LINE_STOPS = 20
+
+# 2000 shapes of 10 segments, 50 points each - 1M points in shapes.txt
+_SHAPES_SCRIPT = """
+import time
+import numpy as np
+from scripts import shapes
+random = np.random.RandomState(1)
+stops = ["%06d" % i for i in range({segments})]
+shaper = shapes.Shaper.__new__(shapes.Shaper) # without loading any OSM data
+shaper.transport, shaper.router = "bus", True
+shaper.failed, shaper.routed = {{}}, {{}}
+for i, start_stop in enumerate(stops):
+    points = np.cumsum(random.normal(0, 0.0003, ({points} + 1, 2)), axis=0) + [52.2, 21.0]
+    # Older versions kept points of segments as lists, without distances between them
+    if hasattr(shapes, "_distances"): segment = ("success", 1, 2, points, shapes._distances(points))
+    else: segment = ("success", 1, 2, points.tolist())
+    shaper.routed[("bus", start_stop, stops[(i + 1) % len(stops)])] = segment
+best = None
+for i in range({repeat}):
+    shaper.trips, shaper.pointTexts = {{}}, {{}}
+    shaper.file = open("output/shapes.txt", "w", encoding="utf-8", newline="\\r\\n")
+    start = time.perf_counter()
+    for shape in range({shapes}):
+        first = shape * 7919 % ({segments} - {length})
+        shaper.get("L/P%d/X" % shape, stops[first:first + {length} + 1])
+    shaper.file.close()
+    took = time.perf_counter() - start
+    best = took if best is None else min(best, took)
+print(best)
+"""
+_SHAPES = 2000
+_SHAPE_SEGMENTS = 10
+_SEGMENT_POINTS = 50
+
+_BRIGADES_SCRIPT = """
+import datetime, json, os, shutil, time
+from urllib.parse import urlparse, parse_qsl
+import requests
+import warsawgtfs_realtime as rt
+
+class RecordedDay(datetime.datetime):
+    @classmethod
+    def today(cls): return cls.strptime({date!r}, "%Y%m%d") + datetime.timedelta(hours=12)
+    @classmethod
+    def now(cls, tz=None): return cls.today()
+rt.datetime = RecordedDay
+
+# Responses are read from the API cache; requests made without it (by older versions) are answered with recorded responses too
+with open({responses!r}, encoding="utf-8") as f: responses = json.load(f)
+class RecordedResponse(object):
+    status_code = 200
+    def __init__(self, result): self.text = json.dumps({{"result": result}})
+    def raise_for_status(self): pass
+    def json(self): return json.loads(self.text)
+def get(url, params=None, **kwargs):
+    if params is None: params = dict(parse_qsl(urlparse(url).query))
+    return RecordedResponse(responses.get(params["line"] + "/" + params["busstopId"] + params["busstopNr"], []))
+requests.get = get
+requests.Session.get = lambda self, url, **kwargs: get(url, **kwargs)
+
+best = None
+for i in range({repeat}):
+    os.makedirs("cache/timetables", exist_ok=True)
+    shutil.copy({responses!r}, "cache/timetables/{date}.json")
+    start = time.perf_counter()
+    brigades = rt.Brigades("", {gtfs!r})
+    took = time.perf_counter() - start
+    best = took if best is None else min(best, took)
+with open("output/brigades.json", "w") as f: json.dump(brigades, f, indent=2)
+print(best)
+"""
+
+def _run(root, script, workdir):
+    "Runs script in a new interpreter, with the scripts package imported from root; returns the last line it printed"
+    os.makedirs(os.path.join(workdir, "output"), exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(root))
+    result = subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env, check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return result.stdout.splitlines()[-1]
+
+def _sameFile(file1, file2, tolerance=0.0):
+    "Checks if two csv files are identical; with tolerance, numbers in them may differ by that much"
+    if filecmp.cmp(file1, file2, shallow=False): return True
+    elif not tolerance: return False
+    with open(file1, encoding="utf-8") as f1, open(file2, encoding="utf-8") as f2:
+        for line1, line2 in itertools.zip_longest(f1, f2, fillvalue=""):
+            fields1, fields2 = line1.split(","), line2.split(",")
+            if len(fields1) != len(fields2): return False
+            for field1, field2 in zip(fields1, fields2):
+                if field1 == field2: continue
+                try:
+                    if abs(float(field1) - float(field2)) > tolerance: return False
+                except ValueError:
+                    return False
+    return True
+
+def _sameFiles(dir1, dir2, tolerance=0.0):
+    "Checks if all files created in two directories are identical (see _sameFile)"
+    for path, dirs, files in os.walk(dir1):
+        for name in files:
+            other = os.path.join(dir2, os.path.relpath(path, dir1), name)
+            if not os.path.exists(other) or not _sameFile(os.path.join(path, name), other, tolerance):
+                return False
+    return True
+
+def _writeSyntheticLine(path, trips, stops=_LINE_STOPS):
+    "Writes a ZTM file with one bus line, which has the given number of trips, each calling at all stops"
+    out = ["*KA   1", "   2018-02-01   3  DP  SB  NS", "#KA", "*ZP   %d" % stops]
+    nums = [str(num) for num in range(1000, 1000 + stops)]
+    for num in nums:
+        out.append("   %s   %-30s  --  WARSZAWA" % (num, "PRZYSTANEK %s," % num))
+        out.append("      *PR   1")
+        out.append("         %s01   2      Ul./Pl.: COS,  Kier.: TAM,  Y= 52.%s00     X= 21.%s00    Pu=0" % (num, num, num))
+        out.append("      #PR")
+    out += ["#ZP", "*LL   1", "   Linia:   100  - LINIA ZWYKŁA", "      *TR   1",
+            "         TP-100A1  ,  COS,  WARSZAWA,  ==>  TAM,  WARSZAWA,   --  Kier. A   Poz. 1",
+            "            *LW  %d" % stops]
+    out += ["               r  %s01  PRZYSTANEK  01   --  02  |" % num for num in nums]
+    out += ["            #LW", "      #TR", "      *WK  %d" % (trips * stops)]
+    for trip in range(trips):
+        service = ("DP", "SB", "NS")[trip % 3]
+        start = 240 + trip // 3
+        trip_id = "TP-100A1/%s/%02d.%02d" % (service, start // 60, start % 60)
+        for num, minutes in zip(nums, range(start, start + 2 * stops, 2)):
+            out.append("         %s  %s01 %s  %d.%02d" % (trip_id, num, service, minutes // 60, minutes % 60))
+    out += ["      #WK", "#LL"]
+    with open(path, "w", encoding="windows-1250", newline="\r\n") as file:
+        file.write("\n".join(out) + "\n")
+
+def _compare(script, against, units=None, tolerance=0.0):
+    """Runs script on this checkout (and on against, if given), prints best times.
+    units is an optional (count, name) pair, used to also print time per one unit of work.
+    tolerance is the allowed difference between numbers in outputs of both checkouts.
+    """
+    roots = [_ROOT] + ([against] if against else [])
+    with tempfile.TemporaryDirectory() as tempdir:
+        times = []
+        for num, root in enumerate(roots):
+            times.append(float(_run(root, script, os.path.join(tempdir, str(num)))))
+            perUnit = ", {:.1f} us per {}".format(times[-1] / units[0] * 1e6, units[1]) if units else ""
+            print("{}: {:.3f} s{}".format(os.path.abspath(root), times[-1], perUnit))
+
+        if against:
+            print("Speed-up: {:.2f}x".format(times[1] / times[0]))
+            if not _sameFiles(os.path.join(tempdir, "0"), os.path.join(tempdir, "1"), tolerance): print("Outputs DIFFER")
+            elif tolerance: print("Outputs identical (numbers within {})".format(tolerance))
+            else: print("Outputs identical")
+
+def parse(args):
+    "Times conversion of a ZTM file to GTFS (without shapes, stop names nor any other external data)"
+    script = _PARSE_SCRIPT.format(repeat=args.repeat, file=os.path.abspath(args.file), config=_PARSE_CONFIG)
+    _compare(script, args.against)
+
+def line(args):
+    "Times conversion of synthetic ZTM files with one long bus line, to show how the cost grows with trips per line"
+    with tempfile.TemporaryDirectory() as tempdir:
+        for trips in _LINE_TRIPS:
+            file = os.path.join(tempdir, "RA%d.TXT" % trips)
+            _writeSyntheticLine(file, trips)
+            print("Line with {} trips of {} stops:".format(trips, _LINE_STOPS))
+            _compare(_PARSE_SCRIPT.format(repeat=args.repeat, file=file, config=_PARSE_CONFIG), args.against, (trips, "trip"))
+
+def shapes(args):
+    "Times calculation of shape_dist_traveled and writing of shapes.txt for 1M already routed points"
+    script = _SHAPES_SCRIPT.format(repeat=args.repeat, shapes=_SHAPES, length=_SHAPE_SEGMENTS, points=_SEGMENT_POINTS, segments=1000)
+    # numpy's and math's trigonometric functions may differ in the last bit, so do distances calculated by different versions
+    _compare(script, args.against, (_SHAPES * (_SHAPE_SEGMENTS * _SEGMENT_POINTS + 1), "point"), 1e-9)
+
+def brigades(args):
+    "Times creation of brigades table from a GTFS file, with API UM responses recorded on the same day"
+    script = _BRIGADES_SCRIPT.format(repeat=args.repeat, gtfs=os.path.abspath(args.gtfs), responses=os.path.abspath(args.responses), date=args.date)
+    _compare(script, args.against)
+
+if __name__ == "__main__":
+    argprs = argparse.ArgumentParser(description="Timing benchmarks of WarsawGTFS")
+    argprs.add_argument("-a", "--against", default="", metavar="DIR", dest="against", help="also run the benchmark on WarsawGTFS checked out in DIR, and compare outputs")
+    argprs.add_argument("-r", "--repeat", default=5, type=int, metavar="N", dest="repeat", help="run the benchmark N times, best time is reported")
+    commands = argprs.add_subparsers(dest="command")
+    commands.required = True
+
+    parseCmd = commands.add_parser("parse", help=parse.__doc__)
+    parseCmd.add_argument("file", help="ZTM file (RAyymmdd.TXT)")
+    parseCmd.set_defaults(func=parse)
+
+    lineCmd = commands.add_parser("line", help=line.__doc__)
+    lineCmd.set_defaults(func=line)
+
+    shapesCmd = commands.add_parser("shapes", help=shapes.__doc__)
+    shapesCmd.set_defaults(func=shapes)
+
+    brigadesCmd = commands.add_parser("brigades", help=brigades.__doc__)
+    brigadesCmd.add_argument("gtfs", help="GTFS file (zip)")
+    brigadesCmd.add_argument("responses", help="API UM responses, as saved by warsawgtfs_realtime.py in cache/timetables/yyyymmdd.json")
+    brigadesCmd.add_argument("date", help="day (yyyymmdd) on which responses were recorded")
+    brigadesCmd.set_defaults(func=brigades)
+
+    args = argprs.parse_args()
+    args.func(args)
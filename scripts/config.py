@@ -3,7 +3,11 @@ import os
 params = {"nameDecap":"""
 # Should the script try to download proper cased stop names from ZTM's website?
 # Otherwise all names shown to user will be in all UPPER cased
-nameDecap: false""", "getMissingStops": """
+nameDecap: false""", "nameDecapOffline": """
+# Should proper cased stop names be taken only from the local cache (cache/stop_names.json)?
+# No requests to ZTM's website will be made, names of stops missing from the cache will be title-cased.
+# Used only if nameDecap is turned on.
+nameDecapOffline: false""", "getMissingStops": """
 # Should missing stops be downloaded from gist avaible at https://gist.github.com/MKuranowski/05f6e819a482ccec606caa64573c9b5b ?
 getMissingStops: true""", "parseWKD": """
 # Should the script parse WKD schedules?
@@ -24,10 +28,13 @@ addMetro: false""", "getRailwayPlatforms": """
 # Otherwise every railway station/halt will have only one entry in stops.txt
 getRailwayPlatforms: true""", "shapes": """
 # Should the script generate shapes from data avilable at https://mkuran.pl/feed/ztm/ztm-km-rail-shapes.osm (for Tram and Rail) and OSM (for buses)?
-# Routing on OSM graphs will be done via pyroutelib3
+# OSM data will be parsed with pyroutelib3 and compiled into graphs kept in cache/graphs/
 # This will have large influence on parse time
 shapes: false
-"""}
+""", "keepArchives": """
+# How many downloaded ZTM files should be kept in cache/archives/?
+# Kept files are used instead of downloading them again, e.g. when parsing schedules for a past date or after a failed run.
+keepArchives: 5"""}
 
 def create(missingParams):
     if not os.path.exists("config.yaml"):
@@ -1,39 +1,361 @@
+import io
 import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import pylzma
 import py7zlib
-from ftplib import FTP
-from datetime import datetime, date, timedelta
+from warnings import warn
+from ftplib import FTP, error_perm, all_errors
+from datetime import date
+
+_CHUNK_SIZE = 65536
+
+# Private attributes of py7zlib's ArchiveFile (pylzma 0.4 - 0.6) used to decompress members incrementally
+_MEMBER_ATTRS = ("_folder", "_start", "_src_start", "_file")
+
+_FTP_HOST = "rozklady.ztm.waw.pl"
+_FTP_FILE = re.compile(r"^RA(\d{6})\.7z$")
+_FTP_PORT = 21
+_FTP_TIMEOUT = 60
+_FTP_ATTEMPTS = 5 # interrupted downloads are resumed that many times
+
+# Downloaded files are kept as <sha256>.7z, most recently used _ARCHIVE_KEEP of them are retained
+_ARCHIVE_DIR = "cache/archives"
+_ARCHIVE_KEEP = 5
+
+# Name, size and modification time of the last downloaded file
+_STATE_FILE = "cache/ztm_file.json"
+
+def _memberChunks(member):
+    """Yields decompressed content of a 7z archive member in chunks.
+    Members compressed with a single LZMA/LZMA2 coder are decompressed incrementally,
+    other members (or all of them, if py7zlib internals are not as expected) are read at once.
+    """
+    if not all(hasattr(member, attr) for attr in _MEMBER_ATTRS) or not hasattr(member._folder, "coders"):
+        warn("Unsupported py7zlib version, {} will be decompressed into memory".format(getattr(member, "filename", "archive member")))
+        yield member.read()
+        return
+
+    coders = member._folder.coders
+    if len(coders) != 1 or coders[0].get("method") not in (py7zlib.COMPRESSION_METHOD_LZMA, py7zlib.COMPRESSION_METHOD_LZMA2):
+        yield member.read()
+        return
+
+    decompressor = pylzma.decompressobj(maxlength=member._start + member.size, lzma2=coders[0]["method"] == py7zlib.COMPRESSION_METHOD_LZMA2)
+    if coders[0].get("properties"):
+        decompressor.decompress(coders[0]["properties"])
+
+    # In solid archives member starts member._start bytes into decompressed folder
+    skip, remaining = member._start, member.size
+    member._file.seek(member._src_start)
+    while remaining > 0:
+        data = member._file.read(_CHUNK_SIZE)
+        chunk = decompressor.decompress(data)
+        if not chunk and not data:
+            raise py7zlib.DecompressionError("end of stream while decompressing")
+        if skip:
+            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        if chunk: yield chunk
+
+class PackedFile(io.RawIOBase):
+    """Read-only binary stream of a 7z archive member, decompressed on the fly.
+    If archivefile (the file the archive was opened from) is given, it's closed together with the stream.
+    """
+    def __init__(self, member, archivefile=None):
+        self.member = member
+        self.archivefile = archivefile
+        self.seek(0)
+
+    def close(self):
+        super().close()
+        if self.archivefile is not None:
+            self.archivefile.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        "Only rewinding to the start is supported"
+        if pos != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("PackedFile can only seek to the start")
+        self.chunks = _memberChunks(self.member)
+        self.buffer = b""
+        self.pos = 0
+        return 0
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b""
+                return 0
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.pos += size
+        return size
 
 def decompress():
     "Decompresses input/ztm_pack.7z and returns list of files"
-    archive = py7zlib.Archive7z(open("input/ztm_pack.7z", "rb"))
-    for name in archive.getnames():
-        outfile = open(os.path.join("input", name), "wb")
-        outfile.write(archive.getmember(name).read())
-        outfile.close()
-    return(archive.getnames())
-
-def download(fileDate="", previousDate=""):
+    with open("input/ztm_pack.7z", "rb") as archivefile:
+        archive = py7zlib.Archive7z(archivefile)
+        for name in archive.getnames():
+            with open(os.path.join("input", name), "wb") as outfile:
+                for chunk in _memberChunks(archive.getmember(name)):
+                    outfile.write(chunk)
+        return(archive.getnames())
+
+def openpacked():
+    """Opens the first file from input/ztm_pack.7z as a text file, without extracting it to disk.
+    Returns a tuple (path the file would be extracted to, file object).
+    """
+    archivefile = open("input/ztm_pack.7z", "rb")
+    try:
+        archive = py7zlib.Archive7z(archivefile)
+        name = archive.getnames()[0]
+        packed = PackedFile(archive.getmember(name), archivefile)
+    except Exception:
+        archivefile.close()
+        raise
+    stream = io.TextIOWrapper(io.BufferedReader(packed), encoding="windows-1250")
+    return(os.path.join("input", name), stream)
+
+def _connect(host, port):
+    "Returns FTP connection to host:port, already logged in"
+    server = FTP(timeout=_FTP_TIMEOUT)
+    try:
+        server.connect(host, port)
+        server.login()
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def _pickFile(files, fileDate="", host=_FTP_HOST):
+    "Returns name of the newest RA%y%m%d.7z file from files (listed on host), which is effective at fileDate (%y%m%d), or today"
+    limit = fileDate or date.today().strftime("%y%m%d")
+    dates = [m.group(1) for m in map(_FTP_FILE.match, files) if m and m.group(1) <= limit]
+    if not dates:
+        raise FileNotFoundError("No ZTM file effective at {} on {}".format(limit, host))
+    return "RA%s.7z" % max(dates)
+
+def _fileInfo(server, fname):
+    "Returns dict with name, size and modification time (from SIZE and MDTM commands, None if not supported) of fname"
+    # SIZE of files is often only available in binary mode
+    try:
+        server.voidcmd("TYPE I")
+        size = server.size(fname)
+    except error_perm:
+        size = None
+    try: modified = server.sendcmd("MDTM " + fname).split()[-1]
+    except error_perm: modified = None
+    return {"name": fname, "size": size, "modified": modified}
+
+def lastDownload():
+    "Returns info (as returned by check) about the last successfully parsed file, or None"
+    try:
+        with open(_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _fileHash(path):
+    "Returns sha256 hex digest of file at path"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _retrieve(fname, path, host=_FTP_HOST, port=_FTP_PORT):
+    """Downloads fname from the FTP server at host:port to path. If path already exists, transfer is resumed from its end (with REST),
+    or, if the server rejects REST, path is truncated and the whole file is downloaded again.
+    """
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    server = _connect(host, port)
+    try:
+        # retrbinary sends REST again right before RETR, this only checks whether it's supported
+        if offset:
+            server.voidcmd("TYPE I")
+            try:
+                server.sendcmd("REST %d" % offset)
+            except error_perm as e:
+                print("Server can't resume download of {} ({}), starting again".format(fname, e))
+                offset = 0
+        with open(path, "ab" if offset else "wb") as f:
+            server.retrbinary("RETR " + fname, f.write, rest=offset or None)
+        server.quit()
+    finally:
+        server.close()
+
+class ArchiveStore(object):
+    """Local store of downloaded ZTM files. Files are kept in directory as <sha256>.7z,
+    and index.json maps name, size and modification time of files on the FTP server (at host:port) to them.
+    Only keep most recently used files are retained.
+    """
+    def __init__(self, directory=_ARCHIVE_DIR, keep=_ARCHIVE_KEEP, host=_FTP_HOST, port=_FTP_PORT):
+        self.directory = directory
+        self.keep = max(keep, 1)
+        self.host = host
+        self.port = port
+        self.indexFile = os.path.join(directory, "index.json")
+        try:
+            with open(self.indexFile, "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(info):
+        return "{name}|{size}|{modified}".format(**info)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest + ".7z")
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.indexFile + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.index, f, indent=0, sort_keys=True)
+        os.replace(self.indexFile + ".tmp", self.indexFile)
+
+    def get(self, info):
+        "Returns path to stored file described by info (from check()), or None. Size and hash of stored file are verified first"
+        entry = self.index.get(self.key(info))
+        if entry is None:
+            return None
+        path = self.path(entry["sha256"])
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"] or _fileHash(path) != entry["sha256"]:
+            del self.index[self.key(info)]
+            self.save()
+            return None
+        entry["used"] = time.time()
+        self.save()
+        return path
+
+    def fetch(self, info, attempts=_FTP_ATTEMPTS):
+        """Downloads file described by info (from check()) into the store and returns path to it.
+        Interrupted transfers are resumed, also from a partial file left by a previous run, if it's of the same file version.
+        Raises IOError if size of downloaded file doesn't match info.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        part = os.path.join(self.directory, info["name"] + ".part")
+        partInfo = os.path.join(self.directory, info["name"] + ".json")
+        try:
+            with open(partInfo, "r", encoding="utf-8") as f:
+                resumable = json.load(f) == info
+        except (OSError, ValueError):
+            resumable = False
+        if os.path.exists(part) and (not resumable or info["size"] is None or os.path.getsize(part) > info["size"]):
+            os.remove(part)
+        with open(partInfo, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+
+        for attempt in range(1, attempts + 1):
+            if info["size"] is not None and os.path.exists(part) and os.path.getsize(part) >= info["size"]:
+                break
+            try:
+                _retrieve(info["name"], part, self.host, self.port)
+            except all_errors as e:
+                if attempt == attempts: raise
+                print("Download of {} interrupted ({}), resuming".format(info["name"], e))
+                continue
+            if info["size"] is None:
+                break
+
+        size = os.path.getsize(part)
+        if info["size"] is not None and size != info["size"]:
+            # A shorter file is left to be resumed later
+            if size > info["size"]: os.remove(part)
+            raise IOError("Downloaded {} has {} bytes, expected {}".format(info["name"], size, info["size"]))
+
+        digest = _fileHash(part)
+        os.replace(part, self.path(digest))
+        os.remove(partInfo)
+        self.index[self.key(info)] = {"name": info["name"], "size": size, "modified": info["modified"], "sha256": digest, "used": time.time()}
+        self.prune()
+        self.save()
+        return self.path(digest)
+
+    def prune(self):
+        "Removes all but keep most recently used files from the store"
+        entries = sorted(self.index.items(), key=lambda i: i[1]["used"], reverse=True)
+        self.index = dict(entries[:self.keep])
+        kept = {entry["sha256"] for entry in self.index.values()}
+        for _, entry in entries[self.keep:]:
+            if entry["sha256"] not in kept and os.path.exists(self.path(entry["sha256"])):
+                os.remove(self.path(entry["sha256"]))
+
+def check(fileDate="", previousDate="", host=_FTP_HOST, port=_FTP_PORT):
+    """Checks if there are new schedules effective at fileDate (string with %y%m%d form), or today, on the FTP server at host:port.
+    Only the FTP directory listing is used, and no local files are touched.
+    Schedules are new, if the file name differs from previousDate (RA%y%m%d format),
+    or if the file with that name has changed on the server since it was last parsed (by size and MDTM).
+    Returns dict with name, size and modification time of the new file, or None if there's nothing new.
+    """
+    server = _connect(host, port)
+    try:
+        info = _fileInfo(server, _pickFile(server.nlst(), fileDate, host))
+        server.quit()
+    finally:
+        server.close()
+
+    if info["name"] == "%s.7z" % previousDate:
+        last = lastDownload()
+        if last is None or last["name"] != info["name"] or (last["size"], last["modified"]) == (info["size"], info["modified"]):
+            return(None)
+    return(info)
+
+def saveLastDownload(info):
+    "Remembers info (from check()) of a file, after it has been successfully parsed"
+    os.makedirs(os.path.dirname(_STATE_FILE), exist_ok=True)
+    with open(_STATE_FILE + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    os.replace(_STATE_FILE + ".tmp", _STATE_FILE)
+
+def download(fileDate="", previousDate="", extract=True, checked=None, keep=_ARCHIVE_KEEP, host=_FTP_HOST, port=_FTP_PORT):
     """Downloads schedules effective at fileDate (string with %y%m%d form), or today.
     Then cheks if this file was already parsed, by comapring it with previousDate (RA%y%m%d fomrat).
     Returns filename if a new file has been downloaded oterwise returns None.
+    If extract is False, downloaded archive is left packed - use openpacked() to read it.
+    If checked (info from check()) is given, the file is not checked again.
+    Files are taken from the local ArchiveStore (retaining keep files) if they were already downloaded.
+    host and port of the FTP server can be changed, e.g. to use a local stand-in server.
+    Once the file is parsed, pass checked to saveLastDownload(), so that check() knows it was already parsed.
     """
-    server = FTP("rozklady.ztm.waw.pl")
-    server.login()
-    files = server.nlst()
-    fdate = datetime.strptime(fileDate, "%y%m%d").date() if fileDate else date.today()
-    while True:
-        fname = fdate.strftime("RA%y%m%d.7z")
-        if fname in files:
-            break
-        else:
-            fdate -= timedelta(days=1)
-
-    if fname == "%s.7z" % previousDate:
-        return(None)
+    if checked is None:
+        checked = check(fileDate, previousDate, host, port)
+        if checked is None:
+            return(None)
+
+    fname = checked["name"]
+    store = ArchiveStore(keep=keep, host=host, port=port)
+    stored = store.get(checked)
+    if stored is None:
+        stored = store.fetch(checked)
     else:
-        server.retrbinary("RETR " + fname, open("input/ztm_pack.7z", "wb").write)
+        print("Using {} from {}".format(fname, _ARCHIVE_DIR))
+
+    # cleanup() only removes the link, stored file stays in the store
+    if os.path.exists("input/ztm_pack.7z"): os.remove("input/ztm_pack.7z")
+    try: os.link(stored, "input/ztm_pack.7z")
+    except OSError: shutil.copyfile(stored, "input/ztm_pack.7z")
+
+    if extract:
         files = decompress()
         return(os.path.join("input", files[0]))
+    else:
+        return(os.path.join("input", fname.replace(".7z", ".TXT")))
 
 def findfile():
     "Finds ZTM's file in input dir and returns path to it"
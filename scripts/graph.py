@@ -0,0 +1,288 @@
+from pyroutelib3 import Datastore
+from heapq import heappush, heappop
+from math import asin, sqrt, sin, cos, radians
+import numpy as np
+import hashlib
+import shutil
+import json
+import time
+import os
+
+_GRAPH_DIR = "cache/graphs"
+
+# Bump when the format of compiled graphs changes, so that graphs in older formats are compiled again
+_GRAPH_FORMAT = "2"
+_GRAPH_ARRAYS = ["ids", "lat", "lon", "offsets", "targets", "weights", "costs"]
+
+# Size (in degrees) of cells of grid used to find nearest nodes
+_GRID_CELL = 0.005
+
+# How many nodes are settled by GraphRouter between checks of the deadline
+_DEADLINE_CHECK = 1024
+
+# Links of that many consecutive nodes are read from graph arrays by GraphRouter at once
+_LINK_BLOCK = 64
+
+class _OsmData(Datastore):
+    "pyroutelib3 Datastore, which also remembers positions of all nodes of routable ways"
+    def __init__(self, transport, localfile):
+        self.positions = {}
+        super().__init__(transport, localfile)
+
+    def storeWay(self, wayID, tags, nodes):
+        for node_id, lat, lon in nodes:
+            self.positions[node_id] = (lat, lon)
+        super().storeWay(wayID, tags, nodes)
+
+def _distances(points, ends=None):
+    """Calculate havresine distances (in km) between consecutive points (numpy array of [lat, lon] rows),
+    or, if ends is given, between respective rows of points and ends"""
+    if ends is None: points, ends = points[:-1], points[1:]
+    lat1, lon1 = np.radians(points[:, 0]), np.radians(points[:, 1])
+    lat2, lon2 = np.radians(ends[:, 0]), np.radians(ends[:, 1])
+    d = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2
+    return 2 * 6371 * np.arcsin(np.sqrt(d))
+
+def compileGraph(transport, osmFile, directory, source=""):
+    """Parses OSM file with pyroutelib3 (using its TYPES[transport] weights and access rules)
+    and saves the routing graph as numpy arrays in directory:
+    - ids, lat, lon: OSM id and position of every node. Nodes which can be the start of a route
+      (pyroutelib3's rnodes) come first, graph.json has their count as "routable",
+    - offsets, targets, weights: outgoing links of every node in CSR format, node i is linked to nodes
+      targets[offsets[i]:offsets[i+1]] (which are indices in ids) with respective weights,
+    - costs: cost of every link used by GraphRouter, its length divided by its weight (like in pyroutelib3).
+    """
+    data = _OsmData(transport, osmFile)
+
+    nodes = list(data.rnodes)
+    routable = len(nodes)
+    # Error replies (e.g. from a busy Overpass server) give no nodes - don't replace a working graph with them
+    if not routable:
+        raise ValueError("No routable nodes for {} in downloaded OSM data".format(transport))
+    known = set(nodes)
+    for links in data.routing.values():
+        for node in links:
+            if node not in known:
+                known.add(node)
+                nodes.append(node)
+    index = {node: i for i, node in enumerate(nodes)}
+
+    lat, lon = [], []
+    for node in nodes:
+        position = data.rnodes[node] if node in data.rnodes else data.positions[node]
+        lat.append(position[0])
+        lon.append(position[1])
+
+    offsets, targets, weights = [0], [], []
+    for node in nodes:
+        for target, weight in data.routing.get(node, {}).items():
+            targets.append(index[target])
+            weights.append(weight)
+        offsets.append(len(targets))
+
+    arrays = {"ids": np.array(nodes, dtype=np.int64), "lat": np.array(lat, dtype=np.float64),
+              "lon": np.array(lon, dtype=np.float64), "offsets": np.array(offsets, dtype=np.int64),
+              "targets": np.array(targets, dtype=np.int32), "weights": np.array(weights, dtype=np.float64)}
+    positions = np.column_stack((arrays["lat"], arrays["lon"]))
+    sources = np.repeat(np.arange(len(nodes)), np.diff(arrays["offsets"]))
+    arrays["costs"] = _distances(positions[sources], positions[arrays["targets"]]) / arrays["weights"]
+
+    graphHash = hashlib.sha1(repr((transport, routable)).encode("utf-8"))
+    for name in _GRAPH_ARRAYS:
+        graphHash.update(arrays[name].tobytes())
+
+    # Write to a temporary directory and swap it with the old graph
+    temp = directory + ".tmp"
+    if os.path.exists(temp): shutil.rmtree(temp)
+    os.makedirs(temp)
+    for name in _GRAPH_ARRAYS:
+        np.save(os.path.join(temp, name + ".npy"), arrays[name])
+    with open(os.path.join(temp, "graph.json"), "w", encoding="utf-8") as f:
+        json.dump({"format": _GRAPH_FORMAT, "transport": transport, "source": source, "created": time.time(),
+                   "hash": graphHash.hexdigest(), "routable": routable, "nodes": len(nodes), "edges": len(targets)}, f, indent=2)
+    if os.path.exists(directory): shutil.rmtree(directory)
+    os.replace(temp, directory)
+
+def graphAge(directory):
+    "Returns age of compiled graph in seconds, or None if there is no valid graph in directory"
+    try:
+        with open(os.path.join(directory, "graph.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("format") != _GRAPH_FORMAT:
+        return None
+    return time.time() - meta["created"]
+
+class Graph(object):
+    """Routing graph compiled by compileGraph. Arrays are memory-mapped, so loading takes only a few milliseconds,
+    and processes using the same graph share its memory.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, "graph.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.hash = self.meta["hash"]
+        self.routable = self.meta["routable"]
+        for name in _GRAPH_ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode="r"))
+        self._index = None
+        self._grid = None
+
+    @property
+    def index(self):
+        "Dict mapping OSM node id to its index in arrays, created on first use"
+        if self._index is None:
+            self._index = {node: i for i, node in enumerate(self.ids.tolist())}
+        return self._index
+
+    def _buildGrid(self):
+        "Sorts routable nodes by cells of a _GRID_CELL-sized grid"
+        lat, lon = self.lat[:self.routable], self.lon[:self.routable]
+        self._gridOrigin = (float(lat.min()), float(lon.min()))
+        rows = ((lat - self._gridOrigin[0]) // _GRID_CELL).astype(np.int64)
+        cols = ((lon - self._gridOrigin[1]) // _GRID_CELL).astype(np.int64)
+        self._gridSize = (int(rows.max()) + 1, int(cols.max()) + 1)
+        cells = rows * self._gridSize[1] + cols
+        self._grid = np.argsort(cells, kind="stable")
+        self._gridCells = cells[self._grid]
+
+    def _cellNodes(self, row, col):
+        "Returns indices of routable nodes in given cell of the grid"
+        if row < 0 or col < 0 or row >= self._gridSize[0] or col >= self._gridSize[1]:
+            return self._grid[0:0]
+        cell = row * self._gridSize[1] + col
+        start, end = np.searchsorted(self._gridCells, [cell, cell + 1])
+        return self._grid[start:end]
+
+    def nearest(self, lat, lon):
+        """Returns routable node (index in arrays) nearest to given position (by the same, flat, metric as pyroutelib3's findNode).
+        Cells of the grid are searched in rings around the position, until no closer node can be found.
+        """
+        if not self.routable:
+            return None
+        if self._grid is None:
+            self._buildGrid()
+
+        row = int((lat - self._gridOrigin[0]) // _GRID_CELL)
+        col = int((lon - self._gridOrigin[1]) // _GRID_CELL)
+        best, bestDist = None, float("inf")
+        ring = 0
+        while True:
+            if ring == 0:
+                cells = [(row, col)]
+            else:
+                cells = [(row + d, col + e) for d in range(-ring, ring + 1) for e in (-ring, ring)] + \
+                        [(row + d, col + e) for d in (-ring, ring) for e in range(-ring + 1, ring)]
+            candidates = np.concatenate([self._cellNodes(r, c) for r, c in cells])
+            if len(candidates):
+                candidates.sort()
+                dy = self.lat[candidates] - lat
+                dx = self.lon[candidates] - lon
+                dist = dx * dx + dy * dy
+                i = int(np.argmin(dist))
+                if dist[i] < bestDist or (dist[i] == bestDist and candidates[i] < best):
+                    best, bestDist = int(candidates[i]), float(dist[i])
+
+            # Nodes outside of searched rings are at least ring * _GRID_CELL away
+            if best is not None and bestDist <= (ring * _GRID_CELL) ** 2:
+                break
+            if ring > max(self._gridSize) + abs(row) + abs(col):
+                break
+            ring += 1
+
+        return best
+
+class GraphRouter(object):
+    """A* router on a compiled Graph. When routing to many nodes at once, the heuristic is not used (so it's Dijkstra).
+    Cost of a link is its length divided by its weight, like in pyroutelib3;
+    the heuristic is straight-line distance divided by the largest weight, so found routes are always the shortest.
+    Links of nodes are read from (memory-mapped) graph arrays in blocks of _LINK_BLOCK nodes, when a node in a block is
+    first expanded, and kept as lists, which are much faster to access one element at a time -
+    so only the part of the graph explored by routing is copied into the process.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.maxWeight = float(graph.weights.max()) if len(graph.weights) else 1.0
+        # Plain ndarray views of memory-mapped arrays are much faster to slice
+        self._arrays = [np.asarray(getattr(graph, name)) for name in ("offsets", "targets", "costs", "lat", "lon")]
+        self._blocks = [None] * (len(graph.ids) // _LINK_BLOCK + 1)
+        self._positions = [None] * len(graph.ids)
+
+    def _position(self, node):
+        "Returns (lat, lon, cos(lat)) of node, in radians"
+        lat, lon = radians(self.graph.lat[node]), radians(self.graph.lon[node])
+        return lat, lon, cos(lat)
+
+    def _loadBlock(self, block):
+        """Reads links of nodes in block from graph arrays, returns (offsets, targets, costs) lists,
+        where links of node block * _LINK_BLOCK + i are at offsets[i]:offsets[i+1]. Positions of targets are also remembered."""
+        offsets, targets, costs, lat, lon = self._arrays
+        first = block * _LINK_BLOCK
+        blockOffsets = offsets[first:first + _LINK_BLOCK + 1]
+        start, end = int(blockOffsets[0]), int(blockOffsets[-1])
+        blockTargets = targets[start:end]
+        targetLat, targetLon = np.radians(lat[blockTargets]), np.radians(lon[blockTargets])
+
+        positions = self._positions
+        for target, position in zip(blockTargets.tolist(), zip(targetLat.tolist(), targetLon.tolist(), np.cos(targetLat).tolist())):
+            if positions[target] is None: positions[target] = position
+
+        data = ((blockOffsets - start).tolist(), blockTargets.tolist(), costs[start:end].tolist())
+        self._blocks[block] = data
+        return data
+
+    def route(self, start, ends, deadline=None):
+        """Routes from node start to every node in ends (nodes are indices in graph arrays).
+        Returns (routes, finished): routes is a dict {end: list of nodes on the route} of reached ends;
+        finished is False if routing was stopped because time.monotonic() passed deadline.
+        """
+        blocks, positions, maxWeight, inf = self._blocks, self._positions, self.maxWeight, float("inf")
+        remaining = set(ends)
+        single = next(iter(remaining)) if len(remaining) == 1 else None
+        if single is not None:
+            endLat, endLon, endCos = self._position(single)
+
+        routes = {}
+        distances = {start: 0.0}
+        previous = {start: None}
+        closed = set()
+        queue = [(0.0, 0.0, start)]
+        settled = 0
+
+        while queue and remaining:
+            _, distance, node = heappop(queue)
+            if node in closed: continue
+            closed.add(node)
+
+            if node in remaining:
+                remaining.discard(node)
+                route = []
+                step = node
+                while step is not None:
+                    route.append(step)
+                    step = previous[step]
+                routes[node] = route[::-1]
+
+            settled += 1
+            if deadline and settled % _DEADLINE_CHECK == 0 and time.monotonic() > deadline:
+                return routes, False
+
+            block = blocks[node // _LINK_BLOCK]
+            if block is None: block = self._loadBlock(node // _LINK_BLOCK)
+            offsets, targets, costs = block
+            i = node % _LINK_BLOCK
+            for link in range(offsets[i], offsets[i + 1]):
+                target = targets[link]
+                newDistance = distance + costs[link]
+                if target not in closed and newDistance < distances.get(target, inf):
+                    distances[target] = newDistance
+                    previous[target] = node
+                    # Heuristic is computed inline, as it's the hottest part of routing
+                    if single is None:
+                        heappush(queue, (newDistance, newDistance, target))
+                    else:
+                        lat, lon, cosLat = positions[target]
+                        heappush(queue, (newDistance + 2 * 6371 * asin(sqrt(sin((endLat - lat) * 0.5) ** 2 + cosLat * endCos *
+                                         sin((endLon - lon) * 0.5) ** 2)) / maxWeight, newDistance, target))
+
+        return routes, True
@@ -0,0 +1,56 @@
+import os
+import json
+
+_STORE_DIR = "cache/lines"
+
+class LineStore(object):
+    """Keeps GTFS rows generated for every line of ZTM file between runs, together with line's fingerprint.
+    If the fingerprint hasn't changed, stored rows are used instead of parsing (and shaping) the line again.
+    salt should change whenever anything besides the line block affects the output (e.g. config).
+    """
+    def __init__(self, salt, directory=_STORE_DIR):
+        self.salt = salt
+        self.directory = directory
+        self.seen = set()
+        self.reused = 0
+        self.stored = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, route_id):
+        return os.path.join(self.directory, route_id + ".json")
+
+    def _load(self, route_id, fingerprint):
+        path = self._path(route_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        if entry["salt"] != self.salt or entry["fingerprint"] != fingerprint:
+            return None
+        return entry["fragments"]
+
+    def has(self, route_id, fingerprint):
+        "Checks if rows for given route_id with matching fingerprint are stored"
+        return self._load(route_id, fingerprint) is not None
+
+    def get(self, route_id, fingerprint):
+        "Returns stored rows for given route_id if its fingerprint matches, otherwise None"
+        self.seen.add(route_id)
+        fragments = self._load(route_id, fingerprint)
+        if fragments is not None: self.reused += 1
+        return fragments
+
+    def put(self, route_id, fingerprint, fragments):
+        "Stores rows generated for given route_id"
+        self.seen.add(route_id)
+        path = self._path(route_id)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"salt": self.salt, "fingerprint": fingerprint, "fragments": fragments}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        self.stored += 1
+
+    def prune(self):
+        "Removes stored lines which were not seen in this run"
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") and name[:-5] not in self.seen:
+                os.remove(os.path.join(self.directory, name))
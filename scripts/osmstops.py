@@ -0,0 +1,64 @@
+from warnings import warn
+import overpass
+import json
+import time
+import os
+
+_STOPS_FILE = "cache/osm_stops.json"
+_STOPS_MAX_AGE = 7 * 86400 # after that time stop positions are downloaded again
+_STOPS_QUERY = "node[public_transport=stop_position][network=\"ZTM Warszawa\"]"
+
+# Bump when the format of the file changes, so that files in older formats are not used
+_STOPS_FORMAT = "1"
+
+def downloadStops():
+    "Downloads OSM nodes of ZTM stop_positions from Overpass API, returns dict {stop ref: node id}"
+    stops = {}
+    for i in overpass.API().Get(_STOPS_QUERY)["features"]:
+        try:
+            stops[str(i["properties"]["ref"])] = i["id"]
+        except KeyError:
+            continue
+    return stops
+
+def readStops(location=_STOPS_FILE):
+    "Reads stop positions saved with writeStops, returns (time of download, stops) or None, if there's no valid file"
+    try:
+        with open(location, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("format") != _STOPS_FORMAT or data.get("query") != _STOPS_QUERY:
+        return None
+    return data["created"], data["stops"]
+
+def writeStops(stops, location=_STOPS_FILE):
+    "Saves stop positions (dict {stop ref: node id}) to location"
+    if os.path.dirname(location): os.makedirs(os.path.dirname(location), exist_ok=True)
+    with open(location + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"format": _STOPS_FORMAT, "query": _STOPS_QUERY, "created": time.time(), "stops": stops}, f, indent=0, sort_keys=True)
+    os.replace(location + ".tmp", location)
+
+def loadStops(location=_STOPS_FILE, maxAge=_STOPS_MAX_AGE, refresh=False, offline=False):
+    """Returns dict {stop ref: node id} of ZTM stop_positions in OSM.
+    Saved stop positions are used if they're younger than maxAge, otherwise (or with refresh) they're downloaded again.
+    If the download fails, or with offline, saved stop positions are used regardless of their age.
+    """
+    stored = readStops(location)
+
+    if offline:
+        if stored is None: raise FileNotFoundError("No saved OSM stop positions in {}".format(location))
+        return stored[1]
+
+    elif stored is not None and not refresh and time.time() - stored[0] <= maxAge:
+        return stored[1]
+
+    try:
+        stops = downloadStops()
+    except Exception as e:
+        if stored is None: raise
+        warn("Using saved OSM stop positions from {}, as they couldn't be downloaded: {}".format(location, e))
+        return stored[1]
+
+    writeStops(stops, location)
+    return stops
@@ -0,0 +1,52 @@
+import os
+import json
+import sqlite3
+
+_SEGMENT_CACHE = "cache/shapes.sqlite"
+
+class SegmentCache(object):
+    """Keeps shapes routed between pairs of consecutive stops in a SQLite database, kept between runs.
+    Every segment is stored together with version of the graph it was routed on;
+    segments routed on other graph versions are removed when setVersion is called.
+    endpoints describe everything besides the graph the route depends on (stop positions, OSM nodes of stops).
+    """
+    def __init__(self, location=_SEGMENT_CACHE):
+        if os.path.dirname(location): os.makedirs(os.path.dirname(location), exist_ok=True)
+        self.db = sqlite3.connect(location)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS segments (
+            transport TEXT, start_stop TEXT, end_stop TEXT, version TEXT, endpoints TEXT,
+            status TEXT, start_node TEXT, end_node TEXT, length REAL, points TEXT,
+            PRIMARY KEY (transport, start_stop, end_stop))""")
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def setVersion(self, transport, version):
+        "Sets graph version used for given transport, dropping segments routed on other versions"
+        self.versions[transport] = version
+        self.db.execute("DELETE FROM segments WHERE transport=? AND version!=?", (transport, version))
+
+    def get(self, transport, start_stop, end_stop, endpoints):
+        "Returns (status, start_node, end_node, length, points) of a stored segment, or None"
+        row = self.db.execute("""SELECT status, start_node, end_node, length, points FROM segments
+            WHERE transport=? AND start_stop=? AND end_stop=? AND version=? AND endpoints=?""",
+            (transport, start_stop, end_stop, self.versions.get(transport), endpoints)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], row[1], row[2], row[3], json.loads(row[4])
+
+    def put(self, transport, start_stop, end_stop, endpoints, status, start_node, end_node, length, points):
+        "Stores a routed segment"
+        self.db.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (transport, start_stop, end_stop, self.versions.get(transport), endpoints,
+             status, str(start_node), str(end_node), length, json.dumps(points)))
+
+    def save(self):
+        "Writes stored segments to disk"
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
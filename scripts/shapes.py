@@ -1,15 +1,23 @@
 from math import radians, cos, sin, asin, sqrt
 from tempfile import NamedTemporaryFile
-from pyroutelib3 import Router, TYPES
-from contextlib import contextmanager
+from pyroutelib3 import TYPES
+from .graph import Graph, GraphRouter, compileGraph, graphAge, _distances, _GRAPH_DIR
+from concurrent.futures import ProcessPoolExecutor
 from warnings import warn
-from copy import copy
-from rdp import rdp
-import overpass
+from .segments import SegmentCache
+from .osmstops import loadStops
+import numpy as np
 import requests
-import signal
+import hashlib
+import time
+import os
 
 _RDP_EPSILON = 0.000006
+_ROUTE_TIMEOUT = 10
+_GROUPS_PER_TASK = 4
+# Compiled graphs are used for that long, before OSM data is downloaded again
+_GRAPH_MAX_AGE = 7 * 86400
+
 _RAIL_FILE = "https://mkuran.pl/feed/ztm/ztm-km-rail-shapes.osm"
 _TRAM_FILE = "https://mkuran.pl/feed/ztm/ztm-km-rail-shapes.osm"
 _BUS_FILE = "https://overpass-api.de/api/interpreter?data=%5Bbbox%3A51%2E921819%2C20%2E462668%2C52%2E48293%2C21%2E46385%5D%5Bout%3Axml%5D%3B%28way%5B%22highway%22%3D%22motorway%22%5D%3Bway%5B%22highway%22%3D%22motorway%5Flink%22%5D%3Bway%5B%22highway%22%3D%22trunk%22%5D%3Bway%5B%22highway%22%3D%22trunk%5Flink%22%5D%3Bway%5B%22highway%22%3D%22primary%22%5D%3Bway%5B%22highway%22%3D%22primary%5Flink%22%5D%3Bway%5B%22highway%22%3D%22secondary%22%5D%3Bway%5B%22highway%22%3D%22secondary%5Flink%22%5D%3Bway%5B%22highway%22%3D%22tertiary%22%5D%3Bway%5B%22highway%22%3D%22tertiary%5Flink%22%5D%3Bway%5B%22highway%22%3D%22motorway%22%5D%3Bway%5B%22highway%22%3D%22unclassified%22%5D%3Bway%5B%22highway%22%3D%22minor%22%5D%3Bway%5B%22highway%22%3D%22residential%22%5D%3Bway%5B%22highway%22%3D%22service%22%5D%3B%29%3B%28%2E%5F%3B%3E%3B%29%3Bout%3B%0A"
@@ -18,24 +26,16 @@ _OVERRIDE_RATIO = {"103102-103101": 9, "103103-103101": 9, "207902-201801": 3.5,
                    "600517-607505": 3.8, "205202-205204": 7.6, "100610-100609": 18.4, "201802-226002": 3.8, "325402-325401": 21.9,
                    "400901-400806": 5.5, "600515-607505": 4, "600513-607505": 4.4,"124001-124003": 11, "124202-124201": 13.3, "102813-102811": 9,
                    "105004-115402": 5.5, "243801-203903": 5.2, "301201-301202": 8.3, "600514-607505": 4,}
+_SOURCES = {"train": _RAIL_FILE, "tram": _TRAM_FILE, "bus": _BUS_FILE}
+
+# Bump when changes in routing change the created shapes, so that segments from SegmentCache aren't reused
+_SEGMENT_VERSION = "3"
 
 TYPES["bus"] = {
         "weights": {"motorway": 1.5, "trunk": 1.5, "primary": 1.4, "secondary": 1.3, "tertiary": 1.3,
             "unclassified": 1, "residential": 0.6, "track": 0.3, "service": 0.5},
         "access": ["access", "vehicle", "motor_vehicle", "psv", "bus", "routing:ztm"]}
 
-class Timeout(Exception):
-    pass
-
-@contextmanager
-def limit_time(sec):
-    "Time limter based on https://gist.github.com/Rabbit52/7449101"
-    def handler(x, y): raise Timeout
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(sec)
-    try: yield
-    finally: signal.alarm(0)
-
 def _distance(pt1, pt2):
     "Calculate havresine distance"
     lat1, lon1 = map(radians, pt1)
@@ -45,68 +45,282 @@ def _distance(pt1, pt2):
     d = sin(lat * 0.5) ** 2 + cos(lat1) * cos(lat2) * sin(lon * 0.5) ** 2
     return 2 * 6371 * asin(sqrt(d))
 
-def _totalDistance(points):
-    "Calculate total route distance"
-    total = 0.0
-    for i in range(1, len(points)):
-        total += _distance(points[i-1], points[i])
-    return total
+def _simplify(points, epsilon):
+    """Ramer-Douglas-Peucker algorithm (works just like rdp package's iterative version),
+    but distances of all points between two kept points are calculated at once"""
+    keep = np.ones(len(points), dtype=bool)
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2: continue
+        inner = points[start + 1:end]
+        line = points[end] - points[start]
+        if np.all(line == 0):
+            dist = np.linalg.norm(inner - points[start], axis=1)
+        else:
+            offset = points[start] - inner
+            dist = np.abs(line[0] * offset[:, 1] - line[1] * offset[:, 0]) / np.linalg.norm(line)
+        i = int(np.argmax(dist))
+        if dist[i] > epsilon:
+            stack.append((start, start + 1 + i))
+            stack.append((start + 1 + i, end))
+        else:
+            keep[start + 1:end] = False
+    return points[keep]
+
+def _graphVersion(graph):
+    "Calculate hash of routing graph and of settings affecting routing on it"
+    settings = (_SEGMENT_VERSION, _RDP_EPSILON, sorted(_OVERRIDE_RATIO.items()), graph.hash)
+    return hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()
+
+def _graphDirectory(transport):
+    return os.path.join(_GRAPH_DIR, transport)
+
+class SegmentRouter(object):
+    "Routes between pairs of stops on graph of one transport type"
+    def __init__(self, transport, graph, stops, osmStops):
+        self.transport = transport
+        self.graph = graph
+        self.router = GraphRouter(graph)
+        self.stops = stops
+        self.nearest = {}
+
+        # Stop positions are checked only once: those which aren't routable nodes of the graph are not used
+        if transport in ["tram", "bus"]:
+            self.stopNodes = {stop: graph.index[node] for stop, node in osmStops.items()
+                              if graph.index.get(node, graph.routable) < graph.routable}
+        else:
+            self.stopNodes = {}
+
+    def _node(self, stop):
+        "Returns node (index in graph arrays) of stop: its stop_position (for trams and buses), or the nearest routable node"
+        node = self.stopNodes.get(stop)
+        if node is None:
+            if stop not in self.nearest: self.nearest[stop] = self.graph.nearest(*map(float, self.stops[stop]))
+            node = self.nearest[stop]
+        return node
+
+    def route(self, start_stop, end_stop):
+        "Route between two stops, returns (status, start_node, end_node, points)"
+        return self.routeMany(start_stop, [end_stop])[end_stop]
+
+    def routeMany(self, start_stop, end_stops):
+        """Route from one stop to many stops at once, returns {end_stop: (status, start_node, end_node, points, distances)},
+        where points is a numpy array of [lat, lon] rows, and distances - a numpy array of distances between consecutive points.
+        """
+        start = self._node(start_stop)
+        ends = {end_stop: self._node(end_stop) for end_stop in end_stops}
+
+        # Do route
+        if start is not None:
+            endNodes = {end for end in ends.values() if end is not None}
+            deadline = time.monotonic() + _ROUTE_TIMEOUT * len(endNodes)
+            routes, finished = self.router.route(start, endNodes, deadline)
+
+        results = {}
+        for end_stop, end in ends.items():
+            start_lat, start_lon = map(float, self.stops[start_stop])
+            end_lat, end_lon = map(float, self.stops[end_stop])
+
+            # SafetyCheck - start and end nodes have to be defined
+            if start is not None and end is not None:
+                route = routes.get(end)
+                if route is not None: status = "success"
+                elif finished: status, route = "no_route", []
+                else: status, route = "timeout", []
+
+                # Ratio is checked on the whole route; rdp algorithm is applied only to points (and distances) written to shapes
+                route_points = np.column_stack((self.graph.lat[route], self.graph.lon[route]))
+                dist_ratio = _distances(route_points).sum() / _distance([start_lat, start_lon], [end_lat, end_lon])
+
+                route_points = _simplify(route_points, _RDP_EPSILON)
+                route_distances = _distances(route_points)
+
+                # SafetyCheck - route has to have at least 2 nodes
+                if status == "success" and len(route) <= 1:
+                    status = "to_few_nodes_(%d)" % len(route)
+
+                # SafetyCheck - route can't be unbelivabely long than straight line between stops
+                # Except for stops in same stop group
+                elif start_stop[:4] == end_stop[:4] and dist_ratio > _OVERRIDE_RATIO.get(start_stop + "-" + end_stop, 7):
+                    status = "route_too_long_in_group_ratio:%s" % round(dist_ratio, 2)
+
+                elif start_stop[:4] != end_stop[:4] and dist_ratio > _OVERRIDE_RATIO.get(start_stop + "-" + end_stop, 3.5):
+                    status = "route_too_long_ratio:%s" % round(dist_ratio, 2)
+
+            else:
+                status = "no_nodes_found"
+
+            if status != "success":
+                route_points = np.array([[start_lat, start_lon], [end_lat, end_lon]])
+                route_distances = _distances(route_points)
+
+            if start is not None and end is not None:
+                results[end_stop] = (status, int(self.graph.ids[start]), int(self.graph.ids[end]), route_points, route_distances)
+            else: results[end_stop] = (status, "n/d", "n/d", route_points, route_distances)
+
+        return results
+
+_workerRouter = None
+
+def _initRouteWorker(transport, stops, osmStops):
+    "Initializes a worker process for routing segments, graph is loaded only once per process"
+    global _workerRouter
+    _workerRouter = SegmentRouter(transport, Graph(_graphDirectory(transport)), stops, osmStops)
+
+def _routeInWorker(group):
+    return _workerRouter.routeMany(*group)
 
 class Shaper(object):
-    def __init__(self, enabled):
+    def __init__(self, enabled, refreshGraphs=False, offline=False):
         self.enabled = enabled
-        self.api = overpass.API()
+        self.refreshGraphs = refreshGraphs
+        self.offline = offline
         self.router = None
+        self.routers = {}
+        self.graphs = {}
         self.transport = None
         self.stops = {}
         self.trips = {}
         self.osmStops = {}
         self.failed = {}
+        self.routed = {}
+        self.pointTexts = {}
+        self.cache = SegmentCache()
         self.file = open("output/shapes.txt", "w", encoding="utf-8", newline="\r\n")
         self.file.write("shape_id,shape_pt_sequence,shape_dist_traveled,shape_pt_lat,shape_pt_lon\n")
 
         self._loadStops()
 
     def _loadStops(self):
-        features = self.api.Get("node[public_transport=stop_position][network=\"ZTM Warszawa\"]")["features"]
-        for i in features:
-            try:
-                self.osmStops[str(i["properties"]["ref"])] = i["id"]
-            except KeyError:
-                continue
-
-    def nextRoute(self, short_name, transport):
-        self.trips.clear()
+        "Loads OSM stop_positions of stops, they're downloaded from Overpass only if the saved ones are outdated (and never when offline)"
+        self.osmStops = loadStops(refresh=self.refreshGraphs, offline=self.offline)
 
+    def _transport(self, short_name, transport):
+        "Returns transport used for routing shapes of given route, or None if shapes for it can't be created"
         if transport == "0": transport = "tram"
         elif transport == "3": transport = "bus"
         elif transport == "2": transport = "train"
         else: raise ValueError("Invalid transport type {} for Shaper".format(transport))
 
         if not self.enabled:
-            self.router = None
-
+            return None
 
         elif short_name == "WKD":
             warn("Shape creation is not available for WKD line")
-            self.router = None
+            return None
+
+        return transport
+
+    def _compileGraphs(self, transport):
+        "Downloads OSM data used by transport and compiles graphs of all transports using the same data"
+        url = _SOURCES[transport]
+        temp_xml = NamedTemporaryFile(delete=False)
+        try:
+            response = requests.get(url)
+            response.raise_for_status()
+            temp_xml.write(response.content)
+            temp_xml.close()
+            for other, other_url in sorted(_SOURCES.items()):
+                if other_url == url and other not in self.graphs:
+                    compileGraph(other, temp_xml.name, _graphDirectory(other), url)
+        finally:
+            temp_xml.close()
+            os.remove(temp_xml.name)
+
+    def _loadGraph(self, transport):
+        "Returns Graph of given transport, compiling it if it's missing or outdated (unless offline)"
+        if transport not in self.graphs:
+            age = graphAge(_graphDirectory(transport))
+            if self.offline:
+                if age is None: raise FileNotFoundError("No compiled {} graph in {}".format(transport, _graphDirectory(transport)))
+            elif self.refreshGraphs or age is None or age > _GRAPH_MAX_AGE:
+                try:
+                    self._compileGraphs(transport)
+                except (requests.RequestException, ValueError) as e:
+                    # An outdated graph is better than none; it's compiled again in the next run
+                    if age is None: raise
+                    warn("Can't update {} graph ({}), using the one from {:.1f} days ago".format(transport, e, age / 86400))
+            self.graphs[transport] = Graph(_graphDirectory(transport))
+
+        return self.graphs[transport]
+
+    def _loadRouter(self, transport):
+        "Returns SegmentRouter for given transport"
+        if transport not in self.routers:
+            graph = self._loadGraph(transport)
+            self.routers[transport] = SegmentRouter(transport, graph, self.stops, self.osmStops)
+            self.cache.setVersion(transport, _graphVersion(graph))
 
-        elif transport != self.transport:
-            temp_xml = NamedTemporaryFile(delete=False)
-            if transport == "train":
-                request = requests.get(_RAIL_FILE)
+        return self.routers[transport]
 
-            elif transport == "tram":
-                request = requests.get(_TRAM_FILE)
+    def version(self):
+        "Returns versions of graphs of all transports (see _graphVersion), compiling them if needed"
+        return repr(sorted((transport, _graphVersion(self._loadGraph(transport))) for transport in _SOURCES))
 
+    def nextRoute(self, short_name, transport):
+        self.trips.clear()
+        self.transport = self._transport(short_name, transport)
+        self.router = self._loadRouter(self.transport) if self.transport else None
+
+    def _endpoints(self, transport, start_stop, end_stop):
+        "Describes everything besides the graph that route between two stops depends on"
+        if transport in ["tram", "bus"]: refs = (self.osmStops.get(start_stop), self.osmStops.get(end_stop))
+        else: refs = (None, None)
+        return repr(tuple(map(float, self.stops[start_stop] + self.stops[end_stop])) + refs)
+
+    def _segment(self, transport, start_stop, end_stop):
+        "Returns already routed segment (status, start_node, end_node, points, distances), or None"
+        segment = self.routed.get((transport, start_stop, end_stop))
+        if segment: return segment
+        cached = self.cache.get(transport, start_stop, end_stop, self._endpoints(transport, start_stop, end_stop))
+        if cached:
+            route_points = np.array(cached[4], dtype=np.float64)
+            return cached[0], cached[1], cached[2], route_points, _distances(route_points)
+        return None
+
+    def _store(self, transport, start_stop, end_stop, segment):
+        "Remembers a routed segment, and (unless routing timed out) saves it for next runs"
+        status, start, end, route_points, route_distances = segment
+        self.routed[(transport, start_stop, end_stop)] = segment
+        if status != "timeout":
+            self.cache.put(transport, start_stop, end_stop, self._endpoints(transport, start_stop, end_stop),
+                           status, start, end, float(route_distances.sum()), route_points.tolist())
+
+    def routeSegments(self, patterns, workers=1):
+        """Routes all segments between consecutive stops of given patterns (list of tuples (short_name, transport, stops)),
+        which were not routed before, in a pool of `workers` processes. Shapes are later created from routed segments.
+        """
+        segments = {}
+        for short_name, transport, stops in patterns:
+            transport = self._transport(short_name, transport)
+            if not transport: continue
+            for x in range(1, len(stops)):
+                segments.setdefault(transport, {})[(stops[x-1], stops[x])] = True
+
+        for transport in sorted(segments):
+            router = self._loadRouter(transport)
+            missing = [segment for segment in segments[transport] if not self._segment(transport, *segment)]
+            print("Shaper: routing %d of %d %s segments" % (len(missing), len(segments[transport]), transport))
+
+            # Segments starting at the same stop are routed at once
+            groups = {}
+            for start_stop, end_stop in missing:
+                groups.setdefault(start_stop, []).append(end_stop)
+            groups = list(groups.items())
+
+            if workers > 1 and len(groups) > 1:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_initRouteWorker,
+                        initargs=(transport, self.stops, self.osmStops)) as pool:
+                    results = list(pool.map(_routeInWorker, groups, chunksize=_GROUPS_PER_TASK))
             else:
-                request = requests.get(_BUS_FILE)
+                results = [router.routeMany(*group) for group in groups]
 
-            temp_xml.write(request.content)
-            self.router = Router(transport, temp_xml.name)
-            temp_xml.close()
+            for (start_stop, end_stops), routed in zip(groups, results):
+                for end_stop in end_stops:
+                    self._store(transport, start_stop, end_stop, routed[end_stop])
 
-        self.transport = transport
+        self.cache.save()
 
     def get(self, trip_id, stops):
         pattern_id = trip_id.split("/")[0] + "/" + trip_id.split("/")[1]
@@ -117,80 +331,48 @@ class Shaper(object):
         elif not self.router:
             return None
 
-        pt_seq = 0
-        dist = 0.0
-        distances = {}
+        points = []
+        lengths = []
+        ends = []
 
         for x in range(1, len(stops)):
-            # Find nodes
             start_stop, end_stop = stops[x-1], stops[x]
-            start_lat, start_lon = map(float, self.stops[start_stop])
-            end_lat, end_lon = map(float, self.stops[end_stop])
-
-            try:
-                assert self.transport in ["tram", "bus"]
-                start = self.osmStops[start_stop]
-                assert start in self.router.data.rnodes
-            except (AssertionError, KeyError):
-                start = self.router.data.findNode(start_lat, start_lon)
-
-            try:
-                assert self.transport in ["tram", "bus"]
-                end = self.osmStops[end_stop]
-                assert end in self.router.data.rnodes
-            except (AssertionError, KeyError):
-                end = self.router.data.findNode(end_lat, end_lon)
-
-            # Do route
-            # SafetyCheck - start and end nodes have to be defined
-            if start and end:
-                try:
-                    with limit_time(10):
-                        status, route = self.router.doRoute(start, end)
-                except Timeout:
-                    status, route = "timeout", []
-
-                route_points = list(map(self.router.nodeLatLon, route))
-
-                dist_ratio = _totalDistance(route_points) / _distance([start_lat, start_lon], [end_lat, end_lon])
 
-                # SafetyCheck - route has to have at least 2 nodes
-                if status == "success" and len(route_points) <= 1:
-                    status = "to_few_nodes_(%d)" % len(route)
-
-                # SafetyCheck - route can't be unbelivabely long than straight line between stops
-                # Except for stops in same stop group
-                elif stops[x-1][:4] == stops[x][:4] and dist_ratio > _OVERRIDE_RATIO.get(start_stop + "-" + end_stop, 7):
-                    status = "route_too_long_in_group_ratio:%s" % round(dist_ratio, 2)
-
-                elif stops[x-1][:4] != stops[x][:4] and dist_ratio > _OVERRIDE_RATIO.get(start_stop + "-" + end_stop, 3.5):
-                    status = "route_too_long_ratio:%s" % round(dist_ratio, 2)
-
-                # Apply rdp algorithm
-                route_points = rdp(route_points, epsilon=_RDP_EPSILON)
-
-            else:
-                start, end = "n/d", "n/d"
-                status = "no_nodes_found"
+            # Segments are reused if neither the graph nor the stops have changed
+            segment = self._segment(self.transport, start_stop, end_stop)
+            if not segment:
+                segment = self.router.route(start_stop, end_stop)
+                self._store(self.transport, start_stop, end_stop, segment)
+            status, start, end, route_points, route_distances = segment
 
             if status != "success":
-                route_points = [[start_lat, start_lon], [end_lat, end_lon]]
                 if self.failed.get(start_stop + "-" + end_stop, True):
                     self.failed[start_stop + "-" + end_stop] = False
                     print("Shaper: Error between stops '%s' (%s) - '%s' (%s): %s " % (start_stop, start, end_stop, end, status))
 
-            if x == 1:
-                # See below, except when it's the very first stop of a trip
-                distances[1] = str(dist)
-                self.file.write(",".join([pattern_id, str(pt_seq), str(dist), str(route_points[0][0]),  str(route_points[0][1])]) + "\n")
+            # Points of segments are formatted only once, as they're shared by many shapes
+            texts = self.pointTexts.get((self.transport, start_stop, end_stop))
+            if texts is None:
+                texts = ["%s,%s" % (lat, lon) for lat, lon in route_points.tolist()]
+                self.pointTexts[(self.transport, start_stop, end_stop)] = texts
 
-            for y in range(1, len(route_points)):
-                # Don't write the first point, as it is the same as previous stop pair last point
-                pt_seq += 1
-                dist += _distance(route_points[y-1], route_points[y])
-                self.file.write(",".join([pattern_id, str(pt_seq), str(dist), str(route_points[y][0]), str(route_points[y][1])]) + "\n")
+            # Don't write the first point, as it is the same as previous stop pair last point
+            # Except when it's the very first stop of a trip
+            points.extend(texts if x == 1 else texts[1:])
+            lengths.append(route_distances)
+            ends.append(len(route_distances))
 
-            distances[x + 1] = str(dist)
+        # shape_dist_traveled of every point, and of every stop (at the last point of each segment)
+        dists = np.cumsum(np.concatenate([[0.0]] + lengths)).tolist()
+        stopPoints = np.cumsum([0] + ends).tolist()
+        distances = {x + 1: str(dists[point]) for x, point in enumerate(stopPoints)}
+
+        self.file.write("".join(["%s,%s,%s,%s\n" % (pattern_id, pt_seq, dists[pt_seq], point)
+                                 for pt_seq, point in enumerate(points)]))
 
         self.trips[pattern_id] = distances
         return distances
+
+    def saveCache(self):
+        "Saves routed segments for next runs"
+        self.cache.save()
@@ -0,0 +1,144 @@
+import re
+from collections import namedtuple
+
+# Records yielded by the Tokenizer
+Section = namedtuple("Section", ["marker"])
+CalendarDate = namedtuple("CalendarDate", ["date", "services"])
+StopGroup = namedtuple("StopGroup", ["num", "name", "town_code", "town"])
+Stop = namedtuple("Stop", ["num", "ref", "lat", "lon"])
+StopWithoutPosition = namedtuple("StopWithoutPosition", ["num", "ref"])
+Route = namedtuple("Route", ["id", "desc"])
+Pattern = namedtuple("Pattern", ["id", "direction", "position"])
+PatternStop = namedtuple("PatternStop", ["stop", "on_demand"])
+TimetableHour = namedtuple("TimetableHour", ["hour", "minutes"])
+Departure = namedtuple("Departure", ["time", "trip"])
+StopTime = namedtuple("StopTime", ["trip", "stop", "time"])
+
+_ZP = re.compile(r"(\d{4})\s{3}((.+)(?:,)|(.{30}))\s+(.{2})\s{2}(.+)")
+_PR = re.compile(r"(\d{4})(\d{2}).+Y=\s?([0-9.]+)\s+X=\s?([0-9.]+)")
+_PR_WRONG = re.compile(r"(\d{4})(\d{2}).+Y=[y.]+\s+X=[x.]+")
+_LL = re.compile(r"Linia:\s*([A-Za-z0-9-]*)\s*-\s*(.*)")
+_TR = re.compile(r"(\w{2}-\w+).*,\s+(.*),.*==>\s*(.*),\s*[\w|-]{2}\s*Kier.\s(\w{1})\s+Poz.\s(\d).*")
+_LW = re.compile(r".*(\d{6})\s*.+\s*[\w|-]{2}\s+\d{2}\s+(NŻ|)")
+_WG = re.compile(r"G\s+\d+\s+(\d+):\s+(.+)")
+_WG_MINUTES = re.compile(r"\[(\d{2})")
+_OD = re.compile(r"(\d{1,2}.\d{2})\s+(.{17})")
+
+def _parseKA(line):
+    splited = line.split()
+    return CalendarDate(splited[0].replace("-", ""), splited[2:])
+
+def _parseZP(line):
+    match = _ZP.match(line)
+    if match:
+        return StopGroup(match.group(1), (match.group(3) or match.group(4)).rstrip(","), match.group(5), match.group(6))
+
+def _parsePR(line):
+    match = _PR.match(line)
+    if match:
+        return Stop(match.group(1), match.group(2), match.group(3), match.group(4))
+    match = _PR_WRONG.match(line)
+    if match:
+        return StopWithoutPosition(match.group(1), match.group(2))
+
+def _parseLL(line):
+    match = _LL.match(line)
+    if match:
+        return Route(match.group(1), match.group(2))
+
+def _parseTR(line):
+    match = _TR.match(line)
+    if match:
+        return Pattern(match.group(1), match.group(4), match.group(5))
+
+def _parseLW(line):
+    match = _LW.match(line)
+    if match:
+        return PatternStop(match.group(1), match.group(2) == "NŻ")
+
+def _parseWG(line):
+    match = _WG.match(line)
+    if match:
+        return TimetableHour(match.group(1), _WG_MINUTES.findall(match.group(2)))
+
+def _parseOD(line):
+    match = _OD.match(line)
+    if match:
+        return Departure(match.group(1), match.group(2))
+
+def _parseWK(line):
+    # Fixed layout: 17 chars of trip id, then stop id, day type and time separated by whitespace
+    fields = line[17:].split()
+    if len(fields) > 2 and len(fields[0]) == 6:
+        return StopTime(line[:17], fields[0], fields[2])
+
+_PARSERS = {"KA": _parseKA, "ZP": _parseZP, "PR": _parsePR, "LL": _parseLL, "TR": _parseTR,
+            "LW": _parseLW, "WG": _parseWG, "OD": _parseOD, "WK": _parseWK}
+
+class Tokenizer(object):
+    """Iterates over ZTM file, yielding Section records on every section change
+    and parsed records for content lines of the innermost open section.
+    Content of sections in self.ignored is skipped without being parsed.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.ignored = set()
+
+    def __iter__(self):
+        sections = []
+        section = None
+        lineParser = None
+        for line in self.file:
+            line = line.strip()
+            if not line:
+                continue
+
+            elif line[0] == "*" or line[0] == "#": #Section Change
+                marker = line[:3]
+                name = marker[1:]
+                if marker[0] == "*":
+                    sections.append(name)
+                elif name in sections:
+                    while sections.pop() != name: pass
+
+                section = sections[-1] if sections else None
+                lineParser = _PARSERS.get(section)
+                yield Section(marker)
+
+            elif lineParser and section not in self.ignored: #File Content
+                record = lineParser(line)
+                if record: yield record
+
+def stopGroupIds(file):
+    "Yields ids of all stop groups from ZTM file, stops reading at the end of ZP section"
+    tokens = Tokenizer(file)
+    tokens.ignored = {"KA", "PR"}
+    for record in tokens:
+        if type(record) is StopGroup:
+            yield record.num
+        elif type(record) is Section and record.marker == "#ZP":
+            break
+
+def skipTo(file, marker):
+    "Reads file up to (and including) the line starting section marker"
+    for line in file:
+        if line.strip().startswith(marker):
+            break
+
+def lineBlocks(file):
+    """Yields (route_id, lines) for every Linia: block of LL section.
+    file has to be already read up to the *LL line; reading stops at #LL.
+    """
+    route_id, block = None, []
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        elif line.startswith("Linia:"):
+            if block: yield route_id, block
+            route_id, block = _LL.match(line).group(1), [line]
+        elif line.startswith("#LL"):
+            break
+        elif block:
+            block.append(line)
+    if block: yield route_id, block
@@ -0,0 +1,94 @@
+from itertools import chain
+import numpy as np
+
+# Fare zones of ZTM Warszawa, checked in order. Stops outside of all polygons are in _DEFAULT_ZONE.
+_ZONES = [
+    ("1", [[52.148388984254, 21.188719510403], [52.151983382615, 21.214913963546], [52.153819968698, 21.219640015819], [52.158954108359, 21.234853505339], [52.153056379404, 21.248586415496], [52.167220145199, 21.262920140491], [52.182589837628, 21.260345219837], [52.190496317382, 21.2671902173], [52.194915966248, 21.284184693618], [52.210118306688, 21.261836528086], [52.222660266053, 21.255112230173], [52.250360969561, 21.270207702454], [52.253999672595, 21.268169223602], [52.255024235475, 21.252075969514], [52.262589505643, 21.250402271058], [52.267474723421, 21.190792857943], [52.278963369207, 21.172687947062], [52.287607432149, 21.174817621063], [52.285454778439, 21.16105252442], [52.283407035134, 21.14191228089], [52.306399331024, 21.137534915762], [52.311122297192, 21.122021018832], [52.314519897346, 21.129423915769], [52.323570146111, 21.148499786273], [52.367588271452, 21.144884168517], [52.370942233066, 21.131752073187], [52.367588271457, 21.116045057196], [52.361194076723, 21.108470498967], [52.337312490872, 21.084952890318], [52.367195212411, 21.073108255302], [52.367214865429, 21.028642594251], [52.364044062648, 21.005597054398], [52.360165415946, 20.970985829282], [52.362890987026, 20.955514847691], [52.35753796346, 20.931369602194], [52.37811421553942, 20.887928009033203], [52.379790828551016, 20.818920135498047], [52.3447783246691, 20.80209732055664], [52.307114367928, 20.870837509176], [52.288093077315, 20.867624222786], [52.275119927961, 20.870985030682], [52.25774643651, 20.863195895705], [52.255106330749, 20.86830282169], [52.248945472779, 20.863871812397], [52.24464944293, 20.870491504246], [52.240734044277, 20.868946551854], [52.231942847354, 20.880303024822], [52.227632027929, 20.884798407131], [52.218430708442, 20.87135517554], [52.215236090302, 20.870303749607], [52.2085831851, 20.85940325217], [52.203454771924, 20.852257847355], [52.195392761969, 20.85358822302], [52.192157025424, 20.856391131421], [52.182178688277, 20.867192387125], [52.182099747212, 20.879358887194], [52.181994492244, 20.891267895217], [52.17686301064, 20.902919411187], [52.173415375139, 20.917853950982], [52.167341886406, 20.919723450629], [52.16175459749, 20.928403078972], [52.155890151147, 20.944496333058], [52.147832682117, 20.963400542197], [52.140048664664, 20.983126848404], [52.137006454285, 20.98368474787], [52.129880810768, 20.983309238608], [52.103910645967, 20.984725444992], [52.103040759171, 21.014929800677], [52.096694026023, 21.015975862193], [52.097896877103, 21.022201269313], [52.100335434549, 21.023810594722], [52.112829301927, 21.043991535349], [52.099017311949, 21.083119600447], [52.101798505042, 21.116974442653], [52.103063824589, 21.118626683406], [52.116795504503, 21.129183858047], [52.129001551179, 21.136195152407], [52.131767702545, 21.137868850832], [52.146886294644, 21.17983469306], [52.148387338154, 21.18868598281]]),
+    ("2w", [[52.139019801948, 21.325072288099], [52.144089807948, 21.331767081801], [52.13137419518, 21.356100081987], [52.124392564139, 21.344985007875], [52.112165488697, 21.361550330733], [52.102992980938, 21.368674277867], [52.108264767682, 21.459998130385], [52.135668013574, 21.478537559095], [52.157999729626, 21.431159019047], [52.183688409183, 21.396483420904], [52.199473268765, 21.380690574232], [52.210834897503, 21.293486594743], [52.205785643381, 21.247481345722], [52.174004255582, 21.270827293002], [52.147256622696, 21.255377769077], [52.140830584592, 21.280526160774], [52.147572633412, 21.31185436207], [52.138828842349, 21.325072288096]]),
+]
+_DEFAULT_ZONE = "2"
+
+class ZonePolygon(object):
+    """A zone polygon prepared for repeated point-in-polygon checks (using the even-odd rule):
+    points outside of the bounding box are rejected immediately,
+    and only edges from the point's longitude band are checked.
+    Many points can be checked at once with containsMany, which uses the same bands, padded to a numpy array.
+    """
+    def __init__(self, zone_id, path, bands=64):
+        self.zone_id = zone_id
+        lats, lons = [i[0] for i in path], [i[1] for i in path]
+        self.min_lat, self.max_lat = min(lats), max(lats)
+        self.min_lon, self.max_lon = min(lons), max(lons)
+        self.bands = bands
+        self.band_width = (self.max_lon - self.min_lon) / bands
+        self.edges = [[] for _ in range(bands)]
+
+        y = len(path) - 1
+        for x in range(len(path)):
+            edge = (path[x][0], path[x][1], path[y][0], path[y][1])
+            for band in range(self._band(min(path[x][1], path[y][1])), self._band(max(path[x][1], path[y][1])) + 1):
+                self.edges[band].append(edge)
+            y = x
+
+        # Edges of every band as (x_lat, x_lon, y_lat, y_lon) rows, padded with NaNs (which never cross a point's longitude)
+        self.bandEdges = np.full((bands, max(map(len, self.edges)), 4), np.nan)
+        for band, edges in enumerate(self.edges):
+            if edges: self.bandEdges[band, :len(edges)] = edges
+
+    def _band(self, lon):
+        return min(int((lon - self.min_lon) / self.band_width), self.bands - 1)
+
+    def contains(self, lat, lon):
+        "Checks if point is in polygon"
+        if lat < self.min_lat or lat > self.max_lat or lon < self.min_lon or lon > self.max_lon:
+            return False
+        z = False
+        for x_lat, x_lon, y_lat, y_lon in self.edges[self._band(lon)]:
+            if ((x_lon > lon) != (y_lon > lon)) and (lat < (y_lat - x_lat) * (lon - x_lon) / (y_lon - x_lon) + x_lat):
+                z = not z
+        return z
+
+    def containsMany(self, lat, lon):
+        "Checks which points (given as numpy arrays of lat and lon) are in polygon, returns numpy array of bools"
+        inside = np.zeros(len(lat), dtype=bool)
+        box = (lat >= self.min_lat) & (lat <= self.max_lat) & (lon >= self.min_lon) & (lon <= self.max_lon)
+        if not box.any():
+            return inside
+        lat, lon = lat[box], lon[box]
+        bands = np.minimum(((lon - self.min_lon) / self.band_width).astype(np.int64), self.bands - 1)
+        edges = self.bandEdges[bands]
+        x_lat, x_lon, y_lat, y_lon = edges[:, :, 0], edges[:, :, 1], edges[:, :, 2], edges[:, :, 3]
+        lat, lon = lat[:, None], lon[:, None]
+        # Edges which don't cross point's longitude may divide by zero, but they aren't counted anyway
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossed = ((x_lon > lon) != (y_lon > lon)) & (lat < (y_lat - x_lat) * (lon - x_lon) / (y_lon - x_lon) + x_lat)
+        inside[box] = np.count_nonzero(crossed, axis=1) % 2 == 1
+        return inside
+
+class ZoneIndex(object):
+    "Assigns fare zones to stop positions"
+    def __init__(self, zones=_ZONES, default=_DEFAULT_ZONE):
+        self.polygons = [ZonePolygon(zone_id, path) for zone_id, path in zones]
+        self.default = default
+
+    def zone(self, lat, lon):
+        "Returns zone_id for given lat lon"
+        lat, lon = float(lat), float(lon)
+        for polygon in self.polygons:
+            if polygon.contains(lat, lon):
+                return polygon.zone_id
+        return self.default
+
+    def classify(self, points):
+        "Returns a list of zone_ids for a list of (lat, lon) pairs, all points are checked against a polygon at once"
+        if not points:
+            return []
+        points = np.fromiter(chain.from_iterable(points), dtype=np.float64, count=2 * len(points)).reshape(-1, 2)
+        zones = np.full(len(points), self.default, dtype=object)
+        remaining = np.ones(len(points), dtype=bool)
+        for polygon in self.polygons:
+            inside = np.zeros(len(points), dtype=bool)
+            inside[remaining] = polygon.containsMany(points[remaining, 0], points[remaining, 1])
+            zones[inside] = polygon.zone_id
+            remaining &= ~inside
+        return zones.tolist()
@@ -1,4 +1,4 @@
-def warsawgtfs(getDate="", prevVer="", local=False):
+def warsawgtfs(getDate="", prevVer="", local=False, stream=False, incremental=False, workers=1, refreshGraphs=False, offline=False):
     from scripts import config, finish, get, parser
 
     print("Loading config")
@@ -6,6 +6,14 @@ def warsawgtfs(getDate="", prevVer="", local=False):
     if not conf:
         exit()
 
+    # Check for a new file before touching previous input and output
+    if not local:
+        print("Checking for new ZTM file")
+        checked = get.check(getDate, prevVer)
+        if not checked:
+            print("File already parsed, aborting")
+            return(prevVer)
+
     #Directories cleanup
     get.cleanup(local)
 
@@ -15,14 +23,18 @@ def warsawgtfs(getDate="", prevVer="", local=False):
 
     else:
         print("Downloading ZTM file")
-        filename = get.download(getDate, prevVer)
+        filename = get.download(getDate, prevVer, extract=not stream, checked=checked, keep=conf["keepArchives"])
 
     if not filename:
         print("File already parsed, aborting")
         return(prevVer)
 
     print("Converting to GTFS")
-    parser.parse(filename, conf)
+    if stream and not local:
+        filename, file = get.openpacked()
+        parser.parse(file, conf, incremental, workers, refreshGraphs, offline)
+    else:
+        parser.parse(filename, conf, incremental, workers, refreshGraphs, offline)
 
     if conf["addMetro"]:
         print("Adding metro schedules")
@@ -38,6 +50,10 @@ def warsawgtfs(getDate="", prevVer="", local=False):
     print("Zipping to gtfs.zip")
     finish.compress()
 
+    # Only now the file counts as parsed for later check()s
+    if not local:
+        get.saveLastDownload(checked)
+
     return filename.lstrip("input/").rstrip(".TXT")
 
 if __name__ == "__main__":
@@ -48,8 +64,21 @@ if __name__ == "__main__":
     argprs = argparse.ArgumentParser()
     argprs.add_argument("-l", "--local", action="store_true", required=False, dest="local", help="parse first that matches input/RA*.txt format, instead of downloading the file")
     argprs.add_argument("-d", "--date", default="", required=False, metavar="yymmdd", dest="date", help="date for which schedules should be downloaded, if not today")
+    argprs.add_argument("-s", "--stream", action="store_true", required=False, dest="stream", help="read downloaded ZTM file straight from the archive, without extracting it to input/")
+    argprs.add_argument("-i", "--incremental", action="store_true", required=False, dest="incremental", help="reuse GTFS data of lines which haven't changed since previous run (stored in cache/lines/)")
+    argprs.add_argument("-j", "--jobs", default=1, type=int, required=False, metavar="N", dest="jobs", help="parse lines (or, when shapes are generated, route shapes) in N processes")
+    argprs.add_argument("-g", "--refresh-graphs", action="store_true", required=False, dest="refreshgraphs", help="download OSM data used for shapes (graphs in cache/graphs/ and stop positions) again, even if it is fresh")
+    argprs.add_argument("-o", "--offline", action="store_true", required=False, dest="offline", help="don't download OSM data used for shapes, use the saved one regardless of its age")
+    argprs.add_argument("-c", "--check", action="store_true", required=False, dest="check", help="only check if there's a new ZTM file (not matching --prevver), without downloading it")
     argprs.add_argument("-p", "--prevver", default="", required=False, metavar="RAyymmdd", dest="prevver", help="previous feed_version, if you want to avoid downloading the same file again")
     args = vars(argprs.parse_args())
+    if args["offline"] and args["refreshgraphs"]:
+        argprs.error("--offline and --refresh-graphs can't be used together")
+    if args["check"]:
+        from scripts import get
+        checked = get.check(args["date"], args["prevver"])
+        print("New file available: %s" % checked["name"] if checked else "No new file available")
+        exit(0 if checked else 1)
     print("""
     . . .                         ,---.--.--,---.,---.
     | | |,---.,---.,---.,---.. . .|  _.  |  |__. `---.
@@ -64,7 +93,7 @@ if __name__ == "__main__":
         print("Schedules will be downloaded for today (%s)" % date.today().strftime("%y%m%d"))
     if args["prevver"]:
         print("If active schedules version matches %s, no new file will be created" % args["prevver"])
-    version = warsawgtfs(args["date"], args["prevver"], args["local"])
+    version = warsawgtfs(args["date"], args["prevver"], args["local"], args["stream"], args["incremental"], args["jobs"], args["refreshgraphs"], args["offline"])
     print("=== Done! ===")
     print("Parsed version: %s" % version)
     print("Time elapsed: %s s" % round(time.time() - st, 3))
@@ -1,27 +1,67 @@
 from google.transit import gtfs_realtime_pb2 as gtfs_rt
+from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
+from heapq import heapify, heappush, heappop
+from itertools import accumulate
+from bisect import bisect_left
+from operator import itemgetter
+from threading import Lock
 from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from urllib.parse import unquote
 from urllib import request
 from copy import copy
+from email.utils import formatdate, parsedate_to_datetime
 import feedparser
 import requests
-import sqlite3
 import zipfile
+import asyncio
+import hashlib
+import gzip
 import math
+import sys
+import time
 import json
 import csv
 import re
+import io
 import os
 
 
-# Some random Functions
+# dbtimetable_get method of API UM, used to match brigades
+_TIMETABLE_URL = "https://api.um.warszawa.pl/api/action/dbtimetable_get/"
+_TIMETABLE_ID = "e923fa0e-d96c-43f9-ae6e-60518c9f3238"
+_TIMETABLE_CACHE = "cache/timetables"
+_TIMETABLE_WORKERS = 4
+_TIMETABLE_RATE = 10 # requests per second
+_TIMETABLE_RETRIES = 3
+_TIMETABLE_BACKOFF = 0.5
+_TIMETABLE_TIMEOUT = 30
+
+# Alerts from ZTM website
+_ALERTS_DISRUPTIONS = "http://www.ztm.waw.pl/rss.php?l=1&IDRss=6"
+_ALERTS_CHANGES = "http://www.ztm.waw.pl/rss.php?l=1&IDRss=3"
+_ALERT_CACHE = "cache/alerts.json"
+_ALERT_TTL = 600 # seconds after which descriptions of unchanged alerts are revalidated
+_ALERT_WORKERS = 4
+_ALERT_TIMEOUT = 30
+
+# busestrams_get method of API UM (formatted with apikey and vehicle type), used for positions
+_POSITIONS_URL = "https://api.um.warszawa.pl/api/action/busestrams_get/?resource_id=%20f2e5503e-%20927d-4ad3-9500-4ab9e55deb59&apikey={}&type={}"
+_POSITIONS_TIMEOUT = 30
+_BRIGADES_URL = "https://mkuran.pl/feed/ztm/ztm-brigades.json"
+
+# Positions daemon
+_DAEMON_INTERVAL = 30 # seconds between updates of positions
+
+# HTTP server of positions daemon
+_SERVER_FILES = ["gtfs.zip"] # files served alongside files from output-rt/
+_SERVER_GZIP = (".json", ".pb") # extensions of files which are compressed, if client accepts it
+_SERVER_TYPES = {".pbn": "application/x-protobuf", ".pb": "text/plain; charset=utf-8", ".json": "application/json; charset=utf-8", ".zip": "application/zip"}
+_SERVER_IDLE_TIMEOUT = 30 # seconds after which idle keep-alive connections are closed
+_SERVICE_DAY_START = 4 # hour at which brigades of the next service day are loaded
 
-def _DictFactory(cursor, row):
-    "A simple DictFactory that returns data in a dict"
-    d = {}
-    for idx, col in enumerate(cursor.description): d[col[0]] = row[idx]
-    return d
+# Some random Functions
 
 def _FilterLines(rlist):
     "Filter lines in ZTM alerts to match ids in GTFS"
@@ -51,24 +91,81 @@ def _CleanTags(html):
     if html == "None": return ""
     else: return re.sub("<.*?>", "", html)
 
-def _AlertDesc(link):
-    "Get alert description from website"
-    text = str(request.urlopen(link).read(), "utf-8")
-    soup = BeautifulSoup(text, "html.parser")
+def _AlertDesc(html):
+    "Get alert description from html of its website"
+    soup = BeautifulSoup(html, "html.parser", parse_only=SoupStrainer("div", id="PageContent"))
     descsoup = soup.find("div", id="PageContent")
     if descsoup != None:
-        for tag in descsoup.find_all("table"): tag.decompose()
-        for tag in descsoup.find_all("h4"): tag.decompose()
-        for tag in descsoup.find_all("div", id="PageInfo"): tag.decompose()
-        for tag in descsoup.find_all("div", id="InneKomunikaty"): tag.decompose()
-        for tag in descsoup.find_all("div", class_="InneKomunikatyLinia"): tag.decompose()
-        for tag in descsoup.find_all("div", class_="cb"): tag.decompose()
+        for tag in descsoup.select("table, h4, div#PageInfo, div#InneKomunikaty, div.InneKomunikatyLinia, div.cb"): tag.decompose()
         descwithtags = str(descsoup)
         clean_desc = _CleanTags(descwithtags.replace("</p>", "\n").replace("<br/>", "\n").replace("<br>", "\n").replace("\xa0", " ").replace("  "," "))
         return clean_desc, descwithtags
     else:
         return "", ""
 
+class _AlertCache(object):
+    """Descriptions of alerts, kept in a file between runs.
+    Descriptions are downloaded only for new alerts, alerts whose RSS entry has changed, and every _ALERT_TTL seconds;
+    pages are requested with ETag/Last-Modified, and parsed only if their content has changed.
+    """
+    def __init__(self, location=_ALERT_CACHE):
+        self.location = location
+        self.session = requests.Session()
+        try:
+            with open(location, "r", encoding="utf-8") as f:
+                self.alerts = json.load(f)
+        except (OSError, ValueError):
+            # No cache, or a broken one - all descriptions are downloaded again
+            self.alerts = {}
+        if type(self.alerts) is not dict: self.alerts = {}
+
+    def _fetch(self, link, fingerprint):
+        "Download (if needed) and return the cache entry for link"
+        cached = self.alerts.get(link, {})
+        headers = {}
+        if cached.get("etag"): headers["If-None-Match"] = cached["etag"]
+        if cached.get("modified"): headers["If-Modified-Since"] = cached["modified"]
+        try:
+            response = self.session.get(link, headers=headers, timeout=_ALERT_TIMEOUT)
+            if response.status_code == 304:
+                entry = dict(cached)
+            else:
+                response.raise_for_status()
+                digest = hashlib.sha1(response.content).hexdigest()
+                if digest == cached.get("hash"):
+                    entry = dict(cached)
+                else:
+                    desc, desc_html = _AlertDesc(str(response.content, "utf-8"))
+                    entry = {"hash": digest, "desc": desc, "html": desc_html}
+                entry["etag"] = response.headers.get("ETag", "")
+                entry["modified"] = response.headers.get("Last-Modified", "")
+        except Exception:
+            # Leave the cached description (if any) to be revalidated in the next run
+            return cached or {"desc": "", "html": "", "fingerprint": "", "checked": 0}
+        entry["fingerprint"] = fingerprint
+        entry["checked"] = time.time()
+        return entry
+
+    def descriptions(self, entries):
+        "Return {link: (description, html description)} for entries - a list of (link, fingerprint of RSS entry) pairs"
+        now = time.time()
+        stale = [(link, fingerprint) for link, fingerprint in entries if link not in self.alerts or \
+            self.alerts[link]["fingerprint"] != fingerprint or now - self.alerts[link]["checked"] > _ALERT_TTL]
+        if stale:
+            with ThreadPoolExecutor(max_workers=_ALERT_WORKERS) as pool:
+                for (link, _), entry in zip(stale, pool.map(lambda x: self._fetch(*x), stale)):
+                    self.alerts[link] = entry
+
+        # Forget alerts which are no longer in RSS feeds
+        links = set(link for link, _ in entries)
+        self.alerts = {link: entry for link, entry in self.alerts.items() if link in links}
+        return {link: (self.alerts[link]["desc"], self.alerts[link]["html"]) for link in links}
+
+    def save(self):
+        "Save descriptions to location (atomically, so that a crash never leaves a partial file)"
+        if os.path.dirname(self.location): os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        _Publish(self.location, json.dumps(self.alerts, ensure_ascii=False))
+
 def _FindTrip(timepoint, route, stop, times):
     "Try find trip_id in times for given timepoint route and stop"
     times = list(filter(lambda x: x["routeId"] == route and x["stopId"] == stop, times))
@@ -81,16 +178,6 @@ def _FindTrip(timepoint, route, stop, times):
     #else:
         #print("Trip not found for R%s S%s T%s" % (route, stop, timepoint))
 
-def _TimeDifference(t1, t2):
-    "Check if t2 happended after t1"
-    t1 = [int(x) for x in t1.split(":")]
-    t2 = [int(x) for x in t2.split(":")]
-    if t2[0] >= 24 and t1[0] <= 3: t1[0] += 24 # Fix for after-midnight trips
-    if t1[0] < t2[0]: return(True)
-    elif t1[0] == t2[0] and t1[1] < t2[1]: return(True)
-    elif t1[0] == t2[0] and t1[1] == t2[1] and t1[2] <= t2[2]: return(True)
-    else: return False
-
 def _Distance(pos1, pos2):
     "Calculate the distance between pos1 and pos2 in kilometers"
     lat1, lon1, lat2, lon2 = map(math.radians, [pos1[0], pos1[1], pos2[0], pos2[1]])
@@ -106,14 +193,154 @@ def _Bearing(pos1, pos2):
     y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1) * math.cos(lat2) * math.cos(lon))
     return math.degrees(math.atan2(x, y))
 
+def _Publish(path, data):
+    """Write data (str or bytes) to a temporary file and move it to path, so that readers never see a partial file.
+    If _FeedServer is running, data is also handed to it.
+    """
+    if type(data) is not bytes: data = data.encode("utf-8")
+    with open(path + ".tmp", "wb") as f: f.write(data)
+    os.replace(path + ".tmp", path)
+    if _feedServer: _feedServer.publish(path, data)
+
+def _PublishDifferential(path, container):
+    """Write a DIFFERENTIAL feed with entities of container added or changed since the FULL_DATASET feed at path,
+    and entities deleted from it, to path with "-diff" added to its name. Has to be called before container is written to path.
+    """
+    previous = {}
+    if os.path.exists(path):
+        feed = gtfs_rt.FeedMessage()
+        with open(path, "rb") as f: feed.ParseFromString(f.read())
+        previous = {entity.id: entity.SerializeToString() for entity in feed.entity}
+
+    diff = gtfs_rt.FeedMessage()
+    diff.header.CopyFrom(container.header)
+    diff.header.incrementality = gtfs_rt.FeedHeader.DIFFERENTIAL
+    for entity in container.entity:
+        if previous.pop(entity.id, None) != entity.SerializeToString():
+            diff.entity.add().CopyFrom(entity)
+    for id in previous:
+        deleted = diff.entity.add()
+        deleted.id = id
+        deleted.is_deleted = True
+
+    name, extension = os.path.splitext(path)
+    _Publish(name + "-diff" + extension, diff.SerializeToString())
+
+class _Feed(object):
+    "Contents of a served file with its caching headers; never modified - new versions are new _Feed objects"
+    __slots__ = ["body", "etag", "modified", "mtime", "_gzipped"]
+
+    def __init__(self, body, modified, mtime=None):
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        self.modified = modified
+        self.mtime = mtime
+        self._gzipped = None
+
+    @property
+    def gzipped(self):
+        "Body compressed with gzip, created on first use"
+        if self._gzipped is None: self._gzipped = gzip.compress(self.body, 6)
+        return self._gzipped
+
+class _FeedServer(object):
+    """Minimal asyncio HTTP server of files from output-rt/ (and _SERVER_FILES).
+    Files published by this process are served straight from memory (their _Feed is swapped on every publish),
+    other files are read when they change on disk. Supports GET and HEAD, ETag/Last-Modified with 304 responses,
+    gzip of text files and keep-alive connections.
+    """
+    def __init__(self, directory="output-rt"):
+        self.directory = directory
+        self.feeds = {}
+
+    def publish(self, path, data):
+        "Swap served contents of path, if it's in served directory"
+        if os.path.normpath(os.path.dirname(path)) != os.path.normpath(self.directory): return
+        name = os.path.basename(path)
+        current = self.feeds.get(name)
+        if current is not None and current.body == data: return
+        self.feeds[name] = _Feed(data, time.time())
+
+    def _load(self, name):
+        "Return _Feed of file name, or None if it can't be served"
+        if name in _SERVER_FILES: path = name
+        elif name and "/" not in name and not name.startswith(".") and not name.endswith(".tmp"): path = os.path.join(self.directory, name)
+        else: return None
+
+        feed = self.feeds.get(name)
+        if feed is not None and feed.mtime is None: return feed
+        try: mtime = os.stat(path).st_mtime
+        except OSError: return None
+        if feed is None or feed.mtime != mtime:
+            with open(path, "rb") as f: feed = _Feed(f.read(), mtime, mtime)
+            self.feeds[name] = feed
+        return feed
+
+    def _response(self, method, target, headers):
+        "Return (status, headers, body) for a request"
+        if method not in ("GET", "HEAD"): return "405 Method Not Allowed", [("Allow", "GET, HEAD")], b""
+        name = unquote(target.split("?")[0].lstrip("/"))
+        feed = self._load(name)
+        if feed is None: return "404 Not Found", [], b""
+
+        extension = os.path.splitext(name)[1]
+        compress = extension in _SERVER_GZIP
+        response = [("ETag", feed.etag), ("Last-Modified", formatdate(feed.modified, usegmt=True)), ("Cache-Control", "no-cache")]
+        if compress: response.append(("Vary", "Accept-Encoding"))
+
+        # Conditional requests
+        if "if-none-match" in headers:
+            if feed.etag in [i.strip() for i in headers["if-none-match"].split(",")] or headers["if-none-match"].strip() == "*":
+                return "304 Not Modified", response, b""
+        elif "if-modified-since" in headers:
+            try:
+                if int(feed.modified) <= parsedate_to_datetime(headers["if-modified-since"]).timestamp():
+                    return "304 Not Modified", response, b""
+            except (TypeError, ValueError):
+                pass
+
+        response.append(("Content-Type", _SERVER_TYPES.get(extension, "application/octet-stream")))
+        if compress and "gzip" in headers.get("accept-encoding", ""):
+            response.append(("Content-Encoding", "gzip"))
+            return "200 OK", response, feed.gzipped
+        return "200 OK", response, feed.body
+
+    async def handle(self, reader, writer):
+        "Handle a connection from asyncio.start_server"
+        try:
+            while True:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), _SERVER_IDLE_TIMEOUT)
+                lines = head.decode("latin-1").split("\r\n")
+                try: method, target, version = lines[0].split(" ")
+                except ValueError: break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                status, response, body = self._response(method, target, headers)
+                keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                response += [("Content-Length", str(len(body))), ("Connection", "keep-alive" if keepAlive else "close")]
+                writer.write(("HTTP/1.1 %s\r\n%s\r\n\r\n" % (status, "\r\n".join(": ".join(i) for i in response))).encode("latin-1"))
+                if method != "HEAD": writer.write(body)
+                await writer.drain()
+                if not keepAlive: break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+# Set by PositionsDaemon, if files are served over HTTP
+_feedServer = None
+
 # Main Functions
 
-def Alerts(out_proto=True, out_json=False):
+def Alerts(out_proto=True, out_json=False, out_text=True, out_diff=False):
     "Get ZTM Warszawa Alerts"
     # Grab Entries
-    changes = feedparser.parse("http://www.ztm.waw.pl/rss.php?l=1&IDRss=3").entries
-    disruptions = feedparser.parse("http://www.ztm.waw.pl/rss.php?l=1&IDRss=6").entries
-    idenum = 0
+    changes = feedparser.parse(_ALERTS_CHANGES).entries
+    disruptions = feedparser.parse(_ALERTS_DISRUPTIONS).entries
 
     # Containers
     if out_proto:
@@ -135,68 +362,244 @@ def Alerts(out_proto=True, out_json=False):
         i.effect = 6 # Modified Service
         all_entries.append(i)
 
-    # Alerts
+    # Select entries with lines, and get their descriptions
+    # Alert ids are derived from link and effect, so they don't change when order of entries changes
+    alerts = OrderedDict()
     for entry in all_entries:
-        idenum += 1
         try: lines_raw = entry.title.split(":")[1].strip()
         except IndexError: lines_raw = ""
         lines = _FilterLines(re.findall(r"[0-9a-zA-Z-]{1,3}", lines_raw))
         if lines:
-            # Gather data
-            alert_id = "-".join(["a", str(idenum)])
             link = _CleanTags(str(entry.link))
-            title = _CleanTags(str(entry.description))
-            try: desc, desc_html = _AlertDesc(link)
-            except: desc, desc_html = "", ""
-
-            # Append to gtfs_rt container
-            if out_proto:
-                entity = container.entity.add()
-                entity.id = alert_id
-                alert = entity.alert
-                alert.effect = entry.effect
-                alert.url.translation.add().text = link
-                alert.header_text.translation.add().text = title
-                if desc: alert.description_text.translation.add().text = desc
-                for line in lines:
-                    selector = alert.informed_entity.add()
-                    selector.route_id = line
-
-            # Append to JSON container
-            if out_json:
-                json_container["alerts"].append(OrderedDict((
-                    ("id", alert_id), ("routes", sorted(lines)),
-                    ("effect", "REDUCED_SERVICE" if entry.effect == 2 else "OTHER_EFFECT"),
-                    ("link", link), ("title", title), ("body", desc), ("htmlbody", desc_html)
-                )))
+            alert_id = "-".join(["a", hashlib.sha1(repr((link, entry.effect)).encode("utf-8")).hexdigest()[:12]])
+            fingerprint = hashlib.sha1(repr((entry.get("title"), entry.get("description"), entry.get("published"))).encode("utf-8")).hexdigest()
+            if alert_id not in alerts: alerts[alert_id] = (entry, lines, link, fingerprint)
+
+    cache = _AlertCache()
+    descriptions = cache.descriptions([(link, fingerprint) for _, _, link, fingerprint in alerts.values()])
+    cache.save()
+
+    # Alerts
+    for alert_id, (entry, lines, link, fingerprint) in alerts.items():
+        # Gather data
+        title = _CleanTags(str(entry.description))
+        desc, desc_html = descriptions[link]
+
+        # Append to gtfs_rt container
+        if out_proto:
+            entity = container.entity.add()
+            entity.id = alert_id
+            alert = entity.alert
+            alert.effect = entry.effect
+            alert.url.translation.add().text = link
+            alert.header_text.translation.add().text = title
+            if desc: alert.description_text.translation.add().text = desc
+            for line in lines:
+                selector = alert.informed_entity.add()
+                selector.route_id = line
+
+        # Append to JSON container
+        if out_json:
+            json_container["alerts"].append(OrderedDict((
+                ("id", alert_id), ("routes", sorted(lines)),
+                ("effect", "REDUCED_SERVICE" if entry.effect == 2 else "OTHER_EFFECT"),
+                ("link", link), ("title", title), ("body", desc), ("htmlbody", desc_html)
+            )))
 
     # Export
     if out_proto:
-        with open("output-rt/alerts.pb", "w") as f: f.write(str(container))
-        with open("output-rt/alerts.pbn", "wb") as f: f.write(container.SerializeToString())
+        if out_text: _Publish("output-rt/alerts.pb", str(container))
+        if out_diff: _PublishDifferential("output-rt/alerts.pbn", container)
+        _Publish("output-rt/alerts.pbn", container.SerializeToString())
 
     if out_json:
-        with open("output-rt/alerts.json", "w", encoding="utf8") as f: json.dump(json_container, f, indent=2)
+        _Publish("output-rt/alerts.json", json.dumps(json_container, indent=2))
+
+class _TripMatcher(object):
+    """Index of today's stop_times used to match trips to brigades:
+    times maps (route_id, stop_id) to {timepoint (in seconds): [trip_id, ...]}, remaining holds trips which aren't matched yet.
+    """
+    def __init__(self):
+        self.times = OrderedDict()
+        self.tripPairs = {}
+        self.remaining = set()
+
+    def add(self, route_id, trip_id, stop_id, timepoint):
+        pair = (route_id, stop_id)
+        if pair not in self.times: self.times[pair] = {}
+        self.times[pair].setdefault(timepoint, []).append(trip_id)
+        pairs = self.tripPairs.setdefault(trip_id, [])
+        if pair not in pairs: pairs.append(pair)
+        self.remaining.add(trip_id)
+
+    def plan(self):
+        """Returns a list of not yet queried (route_id, stop_id) pairs, which together cover all unmatched trips.
+        It's a greedy set cover: the pair covering most uncovered trips goes first, ties are broken by order of stop_times.
+        """
+        counts = OrderedDict()
+        for pair, times in self.times.items():
+            trips = set(trip_id for trips in times.values() for trip_id in trips if trip_id in self.remaining)
+            if trips: counts[pair] = len(trips)
+
+        queue = [(-count, order, pair) for order, (pair, count) in enumerate(counts.items())]
+        heapify(queue)
+        covered = set()
+        plan = []
+        while queue:
+            count, order, pair = heappop(queue)
+            if counts[pair] != -count:
+                # Counts only decrease, so outdated entries are put back with the current count
+                if counts[pair] > 0: heappush(queue, (-counts[pair], order, pair))
+                continue
+            plan.append(pair)
+            for trips in self.times[pair].values():
+                for trip_id in trips:
+                    if trip_id in self.remaining and trip_id not in covered:
+                        covered.add(trip_id)
+                        for other in self.tripPairs[trip_id]:
+                            if other in counts: counts[other] -= 1
+        return plan
+
+    def find(self, pair, timepoint):
+        "Returns first unmatched trip departing at timepoint from pair, or None"
+        for trip_id in self.times[pair].get(timepoint, []):
+            if trip_id in self.remaining: return trip_id
+
+    def match(self, trip_id):
+        "Marks trip as matched"
+        self.remaining.discard(trip_id)
+
+    def finish(self, pair):
+        "Removes all remaining times of pair"
+        del self.times[pair]
+
+class _TimetableApi(object):
+    """Client of dbtimetable_get method of api.um.warszawa.pl.
+    Requests are made in a pool of threads sharing one requests.Session, no more than rate per second, and retried with a backoff.
+    Responses are kept in a file in cachedir, which is valid only on the service day it was created (see _ServiceDay).
+    """
+    def __init__(self, apikey, url=_TIMETABLE_URL, cachedir=_TIMETABLE_CACHE, workers=_TIMETABLE_WORKERS, rate=_TIMETABLE_RATE):
+        self.apikey = apikey
+        self.url = url
+        self.workers = workers
+        self.interval = 1 / rate if rate else 0
+        self.calls = 0
+        self.session = requests.Session()
+        self.session.mount(url, requests.adapters.HTTPAdapter(pool_maxsize=workers))
+        self._lock = Lock()
+        self._nextCall = 0.0
+
+        self.cachefile = os.path.join(cachedir, _ServiceDay() + ".json") if cachedir else ""
+        self.cache = {}
+        if self.cachefile and os.path.exists(self.cachefile):
+            with open(self.cachefile, "r", encoding="utf-8") as f:
+                self.cache = json.load(f)
+
+    def _wait(self):
+        "Sleeps until the next call is allowed by rate limit"
+        with self._lock:
+            now = time.monotonic()
+            wait = self._nextCall - now
+            self._nextCall = max(now, self._nextCall) + self.interval
+        if wait > 0: time.sleep(wait)
+
+    def get(self, route_id, stop_id):
+        "Returns departures of route_id from stop_id, as returned by the API"
+        key = route_id + "/" + stop_id
+        if key in self.cache: return self.cache[key]
+        params = {"id": _TIMETABLE_ID, "apikey": self.apikey, "busstopId": stop_id[:4], "busstopNr": stop_id[4:], "line": route_id}
+        for attempt in range(_TIMETABLE_RETRIES):
+            self._wait()
+            try:
+                response = self.session.get(self.url, params=params, timeout=_TIMETABLE_TIMEOUT)
+                response.raise_for_status()
+                result = response.json()["result"]
+                # API UM returns an error message in result instead of an error status
+                if type(result) is not list: raise ValueError("Incorrect response from API UM: %s" % result)
+                break
+            except (requests.RequestException, ValueError, KeyError):
+                if attempt + 1 == _TIMETABLE_RETRIES: raise
+                time.sleep(_TIMETABLE_BACKOFF * 2 ** attempt)
+        with self._lock:
+            self.calls += 1
+            self.cache[key] = result
+        return result
+
+    def getMany(self, pairs):
+        "Yields departures of every (route_id, stop_id) in pairs, in order of pairs"
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            yield from pool.map(lambda pair: self.get(*pair), pairs)
+
+    def saveCache(self):
+        "Saves responses to cachefile, removing files from other days"
+        if not self.cachefile: return
+        directory = os.path.dirname(self.cachefile)
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".json") and os.path.join(directory, name) != self.cachefile:
+                os.remove(os.path.join(directory, name))
+        with open(self.cachefile + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.cache, f)
+        os.replace(self.cachefile + ".tmp", self.cachefile)
+
+def _GtfsRows(gtfs, name, *columns):
+    "Yields tuples with values of columns in every row of GTFS file from zip, reading it line by line"
+    with gtfs.open(name) as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+        header = next(reader)
+        yield from map(itemgetter(*[header.index(column) for column in columns]), reader)
+
+def _Seconds(timepoint):
+    "Convert HH:MM:SS timepoint to seconds since midnight"
+    h, m, s = timepoint.split(":")
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+def _LoadTrips(gtfsloc, day):
+    """Read trips of routes suitable for matching brigades (trams and buses) active on day (YYYYMMDD) from GTFS zip.
+    Returns a _TripMatcher with their stop_times, and a dict {trip_id: (last stop (lat, lon), last departure HH:MM:SS)}.
+    """
+    matcher = _TripMatcher()
+    lastTimes = {}
 
-def Brigades(apikey, gtfsloc="https://mkuran.pl/feed/ztm/ztm-latest.zip", export=False):
+    with zipfile.ZipFile(gtfsloc) as gtfs:
+        # Service_ids active on day
+        services = set(service_id for date, service_id, exception in \
+            _GtfsRows(gtfs, "calendar_dates.txt", "date", "service_id", "exception_type") if date == day and exception == "1")
+
+        # Routes suitable for matching brigades
+        routes = set(route_id for route_id, route_type in _GtfsRows(gtfs, "routes.txt", "route_id", "route_type") if route_type in ["0", "3"])
+
+        # Trips of those routes active on day
+        trips = {}
+        for trip_id, route_id, service_id in _GtfsRows(gtfs, "trips.txt", "trip_id", "route_id", "service_id"):
+            if route_id in routes and service_id in services:
+                trips[sys.intern(trip_id)] = sys.intern(route_id)
+
+        # Stop_times of those trips, only the last stop_time of every trip is remembered
+        for trip_id, stop_id, timepoint, sequence in _GtfsRows(gtfs, "stop_times.txt", "trip_id", "stop_id", "departure_time", "stop_sequence"):
+            route_id = trips.get(trip_id)
+            if route_id is None: continue
+            trip_id, stop_id = sys.intern(trip_id), sys.intern(stop_id)
+            matcher.add(route_id, trip_id, stop_id, _Seconds(timepoint))
+
+            sequence = int(sequence)
+            if trip_id not in lastTimes or lastTimes[trip_id][0] < sequence:
+                lastTimes[trip_id] = (sequence, stop_id, timepoint)
+
+        # Positions of last stops
+        lastStops = set(stop_id for _, stop_id, _ in lastTimes.values())
+        positions = {stop_id: (lat, lon) for stop_id, lat, lon in \
+            _GtfsRows(gtfs, "stops.txt", "stop_id", "stop_lat", "stop_lon") if stop_id in lastStops}
+
+    return matcher, {trip_id: (positions[stop_id], timepoint) for trip_id, (_, stop_id, timepoint) in lastTimes.items()}
+
+def Brigades(apikey, gtfsloc="https://mkuran.pl/feed/ztm/ztm-latest.zip", export=False, apiurl=_TIMETABLE_URL):
     "Create a brigades table to match positions to gtfs"
     # Variables
-    gtfsServices = []
-    gtfsRoutes = []
     brigades = OrderedDict()
-    gtfsStops = {}
-    tripLastTime = {}
-    tripLastStop = {}
-    previousTrip = ""
-    apiCalls = 0
-    today = datetime.today().strftime("%Y%m%d")
-
-    # Initialize DataBase
-    dbc = sqlite3.connect(":memory:")
-    dbc.row_factory = _DictFactory
-    db = dbc.cursor()
-    db.execute("CREATE TABLE stoptimes (route_id varchar(255), trip_id varchar(255), stop_id varchar(255), timepoint varchar(255))")
-    dbc.commit()
+    # Positions count times after midnight as part of the previous service day, so the table is created for it too
+    today = _ServiceDay()
+    api = _TimetableApi(apikey, apiurl)
 
     # Download GTFS
     if gtfsloc.startswith("https://") or gtfsloc.startswith("ftp://") or gtfsloc.startswith("http://"):
@@ -205,109 +608,53 @@ def Brigades(apikey, gtfsloc="https://mkuran.pl/feed/ztm/ztm-latest.zip", export
         gtfsloc = "input/gtfs-rt.zip"
 
     # Read GTFS
-    print("Creating database")
-    with zipfile.ZipFile(gtfsloc) as gtfs:
+    print("Indexing stop_times")
+    matcher, tripLast = _LoadTrips(gtfsloc, today)
 
-        # Routes suitable for matching brigades
-        with gtfs.open("routes.txt") as routes:
-            for line in routes.readlines():
-                line = str(line, "utf-8")
-                if line.split(",")[4] in ["0", "3"]:
-                    gtfsRoutes.append(line.split(",")[0])
-
-        # Service_ids active today
-        with gtfs.open("calendar_dates.txt") as calendars:
-            for line in calendars.readlines():
-                line = str(line, "utf-8")
-                if line.split(",")[0] == today:
-                    gtfsServices.append(line.split(",")[1])
-
-        # Stops for additional information used in parsing vehicles locations
-        with gtfs.open("stops.txt") as stops:
-            for line in stops.readlines():
-                line = str(line, "utf-8")
-                if not line.startswith("stop_id"):
-                    gtfsStops[line.split(",")[0]] = (line.split(",")[4], line.split(",")[5])
-
-        with gtfs.open("stop_times.txt") as stoptimes:
-            for line in stoptimes.readlines():
-                line = str(line, "utf-8")
-                if not line.startswith("trip_id"):
-                    trip_id = line.split(",")[0]
-
-                    # \/ This means previous trip has ended, and we can save additoanl information about that trip
-                    if previousTrip and previousTrip != trip_id:
-                        tripLastTime[previousTrip] = timepoint
-                        tripLastStop[previousTrip] = gtfsStops[stop_id]
-                    previousTrip = copy(trip_id)
-                    timepoint = line.split(",")[2]
-                    stop_id = line.split(",")[3]
-                    route_id = trip_id.split("/")[0]
-                    try: service_id = trip_id.split("/")[2]
-                    except IndexError: service_id = ""
-                    # Save only if route is suitable for matching and is active today
-                    if route_id in gtfsRoutes and service_id in gtfsServices:
-                        db.execute("INSERT INTO stoptimes VALUES (?,?,?,?)", (route_id, trip_id, stop_id, timepoint))
-                        dbc.commit()
-
-            # Save the last trip:
-            tripLastTime[trip_id] = timepoint
-            tripLastStop[trip_id] = stop_id
-
-    dbc.commit()
+    # Routes are kept in order of stop_times
+    for route_id, stop_id in matcher.times:
+        if route_id not in brigades: brigades[route_id] = {}
 
     # Match trips to brigades
+    # Departures of planned pairs may not match all of their trips, so remaining trips are planned again
     print("Matching trips to brigades")
-    while True:
-        print("Geting next stop route pair   ", end="\r")
-        db.execute("SELECT * FROM stoptimes")
-        randomDbEntry = db.fetchone()
-        if not randomDbEntry: break #If there's no more stop-route pairs
-        else:
-            # Get some basic data
-            route_id = randomDbEntry["route_id"]
-            stop_id = randomDbEntry["stop_id"]
-            if route_id not in brigades: brigades[route_id] = {}
-
-            # Call API UM
-            print("Downloading R: %s S: %s       " % (route_id, stop_id), end="\r")
-            apiCallValues = (apikey, stop_id[:4], stop_id[4:], route_id)
-            apiCall = requests.get("https://api.um.warszawa.pl/api/action/dbtimetable_get/?id=e923fa0e-d96c-43f9-ae6e-60518c9f3238&apikey=%s&busstopId=%s&busstopNr=%s&line=%s" % apiCallValues).text
-            apiCalls += 1
-            result = json.loads(apiCall)["result"]
-            if type(result) is not list: incorrect_resopnse_from_um()
-
-            # Iterate over result's departures
-            print("Matching R: %s S: %s          " % (route_id, stop_id), end="\r")
-            for value in result:
-                # Get API timepoint and brigade
-                for key in value["values"]:
-                    if key["key"] == "brygada":
-                        brigade = key["value"].lstrip("0")
-                        if brigade not in brigades[route_id]:
-                            brigades[route_id][brigade] = []
-                    elif key["key"] == "czas":
-                        timepoint = key["value"].lstrip("0")
-
-                # Try to find timepoint in GTFS
-                db.execute("SELECT * FROM stoptimes WHERE route_id=? AND stop_id=? AND timepoint=?", (route_id, stop_id, timepoint))
-                valueTrip = db.fetchone()
-
-                if not valueTrip: # If not found, try to add 24 to hours - this should catch after midnight timepoints
-                    timepointAM = ":".join([str(int(timepoint.split(":")[0]) + 24), timepoint.split(":")[1], timepoint.split(":")[2]])
-                    db.execute("SELECT * FROM stoptimes WHERE route_id=? AND stop_id=? AND timepoint=?", (route_id, stop_id, timepointAM))
-                    valueTrip = db.fetchone()
-
-                if valueTrip:
-                    trip_id = valueTrip["trip_id"]
-                    trip_data = OrderedDict([("trip_id", trip_id), ("last_stop_latlon", tripLastStop[trip_id]), ("last_stop_timepoint", tripLastTime[trip_id])])
-                    brigades[route_id][brigade].append(trip_data)
-                    db.execute("DELETE FROM stoptimes WHERE trip_id=?", (trip_id, ))
-                    dbc.commit()
-
-            # Remove all remaining times of current stop route pair
-            db.execute("DELETE FROM stoptimes WHERE route_id=? AND stop_id=?", (route_id, stop_id))
-            dbc.commit()
+    try:
+        while True:
+            plan = matcher.plan()
+            if not plan: break #If there's no more stop-route pairs
+            print("Downloading %d timetables from API UM" % len(plan))
+            for pair, result in zip(plan, api.getMany(plan)):
+                route_id, stop_id = pair
+
+                # Iterate over result's departures
+                for value in result:
+                    # Get API timepoint and brigade
+                    for key in value["values"]:
+                        if key["key"] == "brygada":
+                            brigade = key["value"].lstrip("0")
+                            if brigade not in brigades[route_id]:
+                                brigades[route_id][brigade] = []
+                        elif key["key"] == "czas":
+                            timepoint = _Seconds(key["value"])
+
+                    # Try to find timepoint in GTFS
+                    trip_id = matcher.find(pair, timepoint)
+
+                    if not trip_id: # If not found, try to add 24 to hours - this should catch after midnight timepoints
+                        trip_id = matcher.find(pair, timepoint + 86400)
+
+                    if trip_id:
+                        trip_data = OrderedDict([("trip_id", trip_id), ("last_stop_latlon", tripLast[trip_id][0]), ("last_stop_timepoint", tripLast[trip_id][1])])
+                        brigades[route_id][brigade].append(trip_data)
+                        matcher.match(trip_id)
+
+                # Remove all remaining times of current stop route pair
+                matcher.finish(pair)
+
+    finally:
+        # Responses are saved even if matching fails, so that they're not downloaded again
+        api.saveCache()
+    print("Made %d calls to API UM" % api.calls)
 
     # Sort everything
     print("\nSorting")
@@ -323,11 +670,102 @@ def Brigades(apikey, gtfsloc="https://mkuran.pl/feed/ztm/ztm-latest.zip", export
             jsonfile.write(json.dumps(brigades, indent=2))
     return brigades
 
-def Positions(apikey, brigades="https://mkuran.pl/feed/ztm/ztm-brigades.json", previous={}, out_proto=True, out_json=False):
+def _ServiceDay():
+    "Return date (YYYYMMDD) of current service day, which lasts until _SERVICE_DAY_START o'clock of the next day"
+    return (datetime.now() - timedelta(hours=_SERVICE_DAY_START)).strftime("%Y%m%d")
+
+def _ServiceTime(now):
+    "Return seconds since start of the service day (midnight of its date, see _ServiceDay) for datetime now"
+    seconds = now.hour * 3600 + now.minute * 60 + now.second
+    return seconds + 86400 if now.hour < _SERVICE_DAY_START else seconds
+
+class _BrigadeTrips(object):
+    "Trips of one brigade, in order: their ids, end times (seconds since service day start) and positions of their last stops"
+    def __init__(self, trips):
+        self.trips = [x["trip_id"] for x in trips]
+        self.index = {trip_id: i for i, trip_id in enumerate(self.trips)}
+        self.ends = [_Seconds(x["last_stop_timepoint"]) for x in trips]
+        self.lastStops = [tuple(map(float, x["last_stop_latlon"])) for x in trips]
+        # Running maximum of end times can be bisected even if trips don't end in order
+        self._reach = list(accumulate(self.ends, max))
+
+    def current(self, now):
+        "Return index of the first trip which hasn't ended at now (seconds since service day start), or of the last trip"
+        return min(bisect_left(self._reach, now), len(self.trips) - 1)
+
+class _BrigadeTable(dict):
+    "Brigades table prepared for Positions: {route: {brigade: _BrigadeTrips}}"
+
+def _LoadBrigades(brigades):
+    "Load brigades table from a path or URL (or take a dict), and prepare it for Positions"
+    if type(brigades) is _BrigadeTable:
+        return brigades
+
+    # Get brigades, if brigades is not already a dict or OrderedDict
+    if type(brigades) is str:
+        if brigades.startswith("ftp://") or brigades.startswith("http://") or brigades.startswith("https://"):
+            brigades = request.urlopen(brigades).read()
+            brigades = json.loads(brigades)
+        else:
+            with open(brigades) as f:
+                brigades = json.loads(f.read())
+
+    # Sort times in brigades, if they're not sorted; brigades without trips are skipped
+    table = _BrigadeTable()
+    for route in brigades:
+        table[route] = {}
+        for brigade, trips in brigades[route].items():
+            if type(brigades) is not OrderedDict: trips = sorted(trips, key=lambda x: x["trip_id"].split("/")[-1])
+            if trips: table[route][brigade] = _BrigadeTrips(trips)
+    return table
+
+def _FetchPositions(apikey, vehicleType, url=_POSITIONS_URL):
+    "Download positions of buses (vehicleType 1) or trams (vehicleType 2) from API UM, returns None if the response is incorrect"
+    response = json.loads(str(request.urlopen(url.format(apikey, vehicleType), timeout=_POSITIONS_TIMEOUT).read(), "utf-8"))
+    if type(response.get("result")) is list: return response["result"]
+    print("WarsawGTFS-RT: Incorrect %s positions response" % ("buses" if vehicleType == 1 else "trams"))
+    return None
+
+class Vehicle(object):
+    "Position of a vehicle, as returned by Positions. It can be also read like a dict, as positions returned by older versions"
+    __slots__ = ["id", "trip_id", "timestamp", "lat", "lon", "bearing"]
+
+    def __init__(self, id):
+        self.id = id
+        self.trip_id = ""
+        self.timestamp = None
+        self.lat = None
+        self.lon = None
+        self.bearing = None
+
+    def asDict(self):
+        "Return position as an OrderedDict for JSON output"
+        data = OrderedDict((("id", self.id), ("trip_id", self.trip_id), ("timestamp", self.timestamp.isoformat()), ("lat", self.lat), ("lon", self.lon)))
+        if self.bearing: data["bearing"] = self.bearing
+        return data
+
+    @classmethod
+    def fromDict(cls, data):
+        "Create Vehicle from a dict with position (returned by older versions of Positions, or read from vehicles.json)"
+        vehicle = cls(data["id"])
+        vehicle.trip_id, vehicle.lat, vehicle.lon, vehicle.bearing = data["trip_id"], data["lat"], data["lon"], data.get("bearing")
+        vehicle.timestamp = data["timestamp"]
+        if type(vehicle.timestamp) is str: vehicle.timestamp = datetime.fromisoformat(vehicle.timestamp)
+        return vehicle
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ or (key == "bearing" and not self.bearing): raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+def Positions(apikey, brigades=_BRIGADES_URL, previous=None, out_proto=True, out_json=False, source=None, apiurl=_POSITIONS_URL, out_text=True, out_diff=False):
     "Get ZTM Warszawa positions"
     # Variables
     positions = OrderedDict()
-    source = []
+    if previous is None: previous = {}
 
     # GTFS-RT Container
     if out_proto:
@@ -343,118 +781,126 @@ def Positions(apikey, brigades="https://mkuran.pl/feed/ztm/ztm-brigades.json", p
         json_container["time"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
         json_container["positions"] = []
 
-    # Get brigades, if brigades is not already a dict or OrderedDict
-    if type(brigades) is str:
-        if brigades.startswith("ftp://") or brigades.startswith("http://") or brigades.startswith("https://"):
-            brigades = request.urlopen(brigades).read()
-            brigades = json.loads(brigades)
-        else:
-            with open(brigades) as f:
-                brigades = json.loads(f.read())
+    brigades = _LoadBrigades(brigades)
 
-    # Sort times in brigades, if they're not sorted
-    if type(brigades) is not OrderedDict:
-        for route in brigades:
-            for brigade in brigades[route]:
-                brigades[route][brigade] = sorted(brigades[route][brigade], key= \
-                    lambda x: x["trip_id"].split("/")[-1])
-
-    # Load data from API UM
-    sourceBuses = str(request.urlopen("https://api.um.warszawa.pl/api/action/busestrams_get/?resource_id=%20f2e5503e-%20927d-4ad3-9500-4ab9e55deb59&apikey={}&type=1".format(apikey)).read(), "utf-8")
-    sourceBuses = json.loads(sourceBuses)
-    sourceTrams = str(request.urlopen("https://api.um.warszawa.pl/api/action/busestrams_get/?resource_id=%20f2e5503e-%20927d-4ad3-9500-4ab9e55deb59&apikey={}&type=2".format(apikey)).read(), "utf-8")
-    sourceTrams = json.loads(sourceTrams)
-
-    # Check if response from API UM is correct, and add it to positions list
-    if type(sourceTrams["result"]) is list: source += sourceTrams["result"]
-    else: print("WarsawGTFS-RT: Incorrect trams positions response")
-    if type(sourceBuses["result"]) is list: source += sourceBuses["result"]
-    else: print("WarsawGTFS-RT: Incorrect buses positions response")
-    del sourceBuses, sourceTrams
+    # Load data from API UM, if source (list of vehicles from API UM) wasn't given
+    if source is None:
+        source = (_FetchPositions(apikey, 2, apiurl) or []) + (_FetchPositions(apikey, 1, apiurl) or [])
 
     # Iterate over results
+    now = datetime.now()
+    serviceTime = _ServiceTime(now)
+    stamps = {}
     for v in source:
         # Read data about position
         lat, lon, route, brigade = v["Lat"], v["Lon"], v["Lines"], v["Brigade"].lstrip("0")
-        tstamp = datetime.strptime(v["Time"], "%Y-%m-%d %H:%M:%S")
+        # Most vehicles share timestamps, so every timestamp is parsed once
+        tstamp = stamps.get(v["Time"])
+        if tstamp is None: tstamp = stamps[v["Time"]] = datetime.strptime(v["Time"], "%Y-%m-%d %H:%M:%S")
         trip_id = ""
         bearing = None
         id = "-".join(["v", route, brigade])
-        try: triplist = brigades[route][brigade]
+        try: trips = brigades[route][brigade]
         except KeyError: continue
 
         # Do not care about obsolete data
-        if (datetime.today() - tstamp) > timedelta(minutes=10): continue
+        if (now - tstamp) > timedelta(minutes=10): continue
 
         # Try to match with trip
         if id in previous:
-            prev_trip, prev_lat, prev_lon, prev_bearing = previous[id]["trip_id"], previous[id]["lat"], previous[id]["lon"], previous[id].get("bearing", None)
-            tripidslist = [x["trip_id"] for x in triplist]
+            prev = previous[id]
+            if type(prev) is not Vehicle: prev = Vehicle.fromDict(prev)
+            prev_trip, prev_lat, prev_lon, prev_bearing = prev.trip_id, prev.lat, prev.lon, prev.bearing
+            prev_trip_index = trips.index.get(prev_trip)
 
             # Get vehicle bearing
             bearing = _Bearing([prev_lat, prev_lon], [lat, lon])
             if (not bearing) and prev_bearing: bearing = prev_bearing
 
             # If vehicle was doing its last trip, there's nothing more that can be calculated
-            if prev_trip == triplist[-1]["trip_id"]:
-                trip_id = copy(prev_trip)
+            if prev_trip_index == len(trips.trips) - 1:
+                trip_id = prev_trip
 
             # The calculations require for the prev_trip to be in the triplist
-            elif prev_trip in tripidslist:
-                prev_trip_index = tripidslist.index(prev_trip)
-                prev_trip_last_latlon = list(map(float, triplist[prev_trip_index]["last_stop_latlon"]))
+            elif prev_trip_index is not None:
                 # If vehicle is near (50m) the last stop => the trip has finished => assume the next trip
                 # Or if the previous trip should've finished 30min earlier (A fallback rule if the previous cause has failed)
-                if _Distance([lat, lon], prev_trip_last_latlon) <= 0.05 or \
-                    _TimeDifference(triplist[prev_trip_index]["last_stop_timepoint"], (datetime.now()-timedelta(minutes=30)).strftime("%H:%M:%S")):
-                    trip_id = triplist[prev_trip_index + 1]["trip_id"]
+                if _Distance([lat, lon], trips.lastStops[prev_trip_index]) <= 0.05 or \
+                    trips.ends[prev_trip_index] <= serviceTime - 1800:
+                    trip_id = trips.trips[prev_trip_index + 1]
                 else:
-                    trip_id = copy(prev_trip)
+                    trip_id = prev_trip
 
         if not trip_id:
             # If the trip_id still is not defined, assume the trip is not delayed
-            currtime = datetime.now().strftime("%H:%M:%S")
-            for trip in triplist:
-                if _TimeDifference(currtime, trip["last_stop_timepoint"]):
-                    trip_id = trip["trip_id"]
-                    break
-            if not trip_id: trip_id = triplist[-1]["trip_id"] # If the trips still couldn't be found - assume it's doing the last trip
-
-        # Save to dict
-        data = OrderedDict()
-        data["id"] = copy(id)
-        data["trip_id"] = copy(trip_id)
-        data["timestamp"] = copy(tstamp)
-        data["lat"] = copy(lat)
-        data["lon"] = copy(lon)
-        if bearing: data["bearing"] = copy(bearing)
-        positions[id] = copy(data)
-
-        # Save to gtfs_rt container
-        if out_proto:
-            entity = container.entity.add()
-            entity.id = id
-            vehicle = entity.vehicle
-            vehicle.trip.trip_id = trip_id
-            vehicle.vehicle.id = id
-            vehicle.position.latitude = float(lat)
-            vehicle.position.longitude = float(lon)
-            if bearing: vehicle.position.bearing = float(bearing)
-            vehicle.timestamp = round(tstamp.timestamp())
+            # If the trips still couldn't be found - assume it's doing the last trip
+            trip_id = trips.trips[trips.current(serviceTime)]
+
+        # Save to dict, a vehicle repeated in source is replaced by its last position
+        vehicle = Vehicle(id)
+        vehicle.trip_id, vehicle.timestamp, vehicle.lat, vehicle.lon, vehicle.bearing = trip_id, tstamp, lat, lon, bearing
+        positions[id] = vehicle
 
     # Export results
     if out_proto:
-        with open("output-rt/vehicles.pb", "w") as f: f.write(str(container))
-        with open("output-rt/vehicles.pbn", "wb") as f: f.write(container.SerializeToString())
+        for vehicle in positions.values():
+            entity = container.entity.add()
+            entity.id = vehicle.id
+            entity.vehicle.trip.trip_id = vehicle.trip_id
+            entity.vehicle.vehicle.id = vehicle.id
+            entity.vehicle.position.latitude = float(vehicle.lat)
+            entity.vehicle.position.longitude = float(vehicle.lon)
+            if vehicle.bearing: entity.vehicle.position.bearing = float(vehicle.bearing)
+            entity.vehicle.timestamp = round(vehicle.timestamp.timestamp())
+
+        if out_text: _Publish("output-rt/vehicles.pb", str(container))
+        if out_diff: _PublishDifferential("output-rt/vehicles.pbn", container)
+        _Publish("output-rt/vehicles.pbn", container.SerializeToString())
 
     if out_json:
-        for i in map(copy, positions.values()):
-            i["timestamp"] = i["timestamp"].isoformat()
-            json_container["positions"].append(i)
-        with open("output-rt/vehicles.json", "w", encoding="utf8") as f: json.dump(json_container, f, indent=2)
+        json_container["positions"] = [vehicle.asDict() for vehicle in positions.values()]
+        _Publish("output-rt/vehicles.json", json.dumps(json_container, indent=2))
 
     return positions
 
+async def _PositionsLoop(apikey, brigades, interval, out_proto, out_json, apiurl, out_text, out_diff, port):
+    "Update positions every interval seconds, reloading brigades when service day changes"
+    global _feedServer
+    loop = asyncio.get_running_loop()
+    serviceDay, table, previous = None, None, {}
+    if port:
+        _feedServer = _FeedServer()
+        await asyncio.start_server(_feedServer.handle, port=port)
+        print("Serving output-rt/ on port %s" % port)
+    while True:
+        start = loop.time()
+        try:
+            day = _ServiceDay()
+            if day != serviceDay:
+                print("Loading brigades for %s" % day)
+                if brigades is None: table = await loop.run_in_executor(None, lambda: _LoadBrigades(Brigades(apikey, export=True)))
+                else: table = await loop.run_in_executor(None, _LoadBrigades, brigades)
+                serviceDay, previous = day, {}
+
+            # Buses and trams are downloaded at the same time
+            trams, buses = await asyncio.gather(loop.run_in_executor(None, _FetchPositions, apikey, 2, apiurl),
+                                                loop.run_in_executor(None, _FetchPositions, apikey, 1, apiurl))
+            # Positions are processed in another thread, so that HTTP server can answer requests in the meantime
+            source = (trams or []) + (buses or [])
+            previous = await loop.run_in_executor(None, lambda: Positions(apikey, table, previous, out_proto, out_json,
+                                                                          source=source, out_text=out_text, out_diff=out_diff))
+        except Exception as e:
+            print("WarsawGTFS-RT: Positions update failed: %s" % e)
+        await asyncio.sleep(max(0, interval - (loop.time() - start)))
+
+def PositionsDaemon(apikey, brigades=_BRIGADES_URL, interval=_DAEMON_INTERVAL, out_proto=True, out_json=False, apiurl=_POSITIONS_URL, out_text=True, out_diff=False, port=None):
+    """Run Positions every interval seconds, until interrupted.
+    Brigades are loaded once per service day, from a path or URL - or, if brigades is None, created with Brigades().
+    If port is given, files from output-rt/ (and gtfs.zip) are served over HTTP on that port.
+    """
+    try: asyncio.run(_PositionsLoop(apikey, brigades, interval, out_proto, out_json, apiurl, out_text, out_diff, port))
+    except KeyboardInterrupt: pass
+
 # A simple interface
 if __name__ == "__main__":
     import argparse
@@ -462,10 +908,15 @@ if __name__ == "__main__":
     argprs.add_argument("-a", "--alerts", action="store_true", required=False, dest="alerts", help="parse alerts into output-rt/")
     argprs.add_argument("-b", "--brigades", action="store_true", required=False, dest="brigades", help="parse brigades into output-rt/")
     argprs.add_argument("-p", "--positions", action="store_true", required=False, dest="positions", help="parse positions into output-rt/")
+    argprs.add_argument("-d", "--daemon", action="store_true", required=False, dest="daemon", help="keep running and update positions (and, with -b, brigades) periodically")
     argprs.add_argument("-k", "--key", default="", required=False, metavar="(apikey)", dest="key", help="apikey from api.um.warszawa.pl")
 
     argprs.add_argument("--json", action="store_true", default=False, required=False, dest="json", help="output additionally rt data to .json format")
+    argprs.add_argument("--port", default=None, type=int, required=False, metavar="(port)", dest="port", help="serve output-rt/ files and gtfs.zip over HTTP on this port in daemon mode")
+    argprs.add_argument("--interval", default=_DAEMON_INTERVAL, type=int, required=False, metavar="(seconds)", dest="interval", help="seconds between updates of positions in daemon mode")
     argprs.add_argument("--no_protobuf", action="store_false", default=True, required=False, dest="proto", help="do not output rt data to GTFS-Realtime format")
+    argprs.add_argument("--differential", action="store_true", default=False, required=False, dest="diff", help="output additionally changes since previous run in DIFFERENTIAL GTFS-Realtime files (*-diff.pbn)")
+    argprs.add_argument("--no_text", action="store_false", default=True, required=False, dest="text", help="do not output human-readable .pb files alongside GTFS-Realtime files")
 
     args = argprs.parse_args()
 
@@ -475,14 +926,24 @@ if __name__ == "__main__":
     if not (args.json or args.proto):
         raise ValueError("No output filetype specified")
 
+    if args.daemon and not args.positions:
+        raise ValueError("Daemon mode requires positions")
+
+    if args.port and not args.daemon:
+        raise ValueError("Serving files over HTTP requires daemon mode")
+
     if args.alerts:
         print("Parsing Alerts")
-        Alerts(out_proto=args.proto, out_json=args.json)
+        Alerts(out_proto=args.proto, out_json=args.json, out_text=args.text, out_diff=args.diff)
 
-    if args.brigades and args.key:
+    if args.brigades and args.key and not args.daemon:
         print("Parsing brigades")
         Brigades(apikey=args.key, export=True)
 
-    if args.positions and args.key:
+    if args.positions and args.key and args.daemon:
+        print("Parsing positions every %s s" % args.interval)
+        PositionsDaemon(apikey=args.key, brigades=None if args.brigades else _BRIGADES_URL, interval=args.interval, out_proto=args.proto, out_json=args.json, out_text=args.text, out_diff=args.diff, port=args.port)
+
+    elif args.positions and args.key:
         print("Parsing positions")
-        Positions(apikey=args.key, out_proto=args.proto, out_json=args.json)
+        Positions(apikey=args.key, out_proto=args.proto, out_json=args.json, out_text=args.text, out_diff=args.diff)